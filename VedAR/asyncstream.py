@@ -0,0 +1,280 @@
+import asyncio
+import re
+import threading
+import time
+from json import dumps
+from urllib.parse import urlsplit, parse_qs
+from encoding import ProfileSelector
+from metrics import registry
+
+# Routes of the streaming server: (feed, session id)
+route_pattern = re.compile(r'^/(video_feed|image_feed|avatar_events|board_events)/([^/]+)$')
+# Seconds between the keepalive comments of the event streams
+keepalive_interval = 15.0
+# Headers of the feeds and event streams, the pages that use them are served by Flask from another origin
+feed_headers = (b'HTTP/1.1 200 OK\r\nContent-Type: multipart/x-mixed-replace; boundary=frame\r\n'
+                b'Cache-Control: no-cache\r\nAccess-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n')
+event_headers = (b'HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\nCache-Control: no-cache\r\n'
+                 b'Access-Control-Allow-Origin: *\r\nConnection: close\r\n\r\n')
+
+
+# Watcher object that wakes up the viewers waiting in the event loop when a stream or board log changes
+# It is notified from the pipeline threads with a single callback per change, whatever the number of viewers
+class Watcher(object):
+    def __init__(self, loop, source):
+        self.loop = loop
+        self.source = source
+        # Futures of the viewers waiting for the next change and number of viewers using the watcher
+        self.waiters = set()
+        self.viewers = 0
+        source.add_listener(self.notify)
+
+    def notify(self):
+        # Called from the pipeline threads
+        self.loop.call_soon_threadsafe(self.wake)
+
+    def wake(self):
+        waiters, self.waiters = self.waiters, set()
+        for waiter in waiters:
+            if not waiter.done():
+                waiter.set_result(None)
+
+    async def wait(self, timeout):
+        # Waits for the next change or the timeout
+        waiter = self.loop.create_future()
+        self.waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter, timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            self.waiters.discard(waiter)
+
+    def close(self):
+        self.source.remove_listener(self.notify)
+
+
+# StreamingServer object that serves the video feeds and event streams of the sessions from an asyncio event loop
+# The viewers wait for the frames without holding a thread each
+class StreamingServer(object):
+    def __init__(self, sessions, host='0.0.0.0', port=5001):
+        self.sessions = sessions
+        self.host = host
+        self.port = port
+        self.loop = None
+        self.thread = None
+        # Set when the server is listening or failed to start, with the error that stopped it
+        self.started = threading.Event()
+        self.error = None
+        # Watchers by the id of the stream or board log they watch
+        self.watchers = dict()
+
+    def start(self):
+        # Runs the event loop in a background thread and waits until the server is listening
+        self.thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name='streaming', daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+        return self
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        try:
+            server = await asyncio.start_server(self.handle, self.host, self.port)
+        except OSError as e:
+            self.error = e
+            return
+        finally:
+            self.started.set()
+        async with server:
+            await server.serve_forever()
+
+    def watch(self, source):
+        watcher = self.watchers.get(id(source))
+        if watcher is None:
+            watcher = self.watchers[id(source)] = Watcher(self.loop, source)
+        watcher.viewers += 1
+        return watcher
+
+    def unwatch(self, source):
+        # The watcher is removed with its last viewer
+        watcher = self.watchers[id(source)]
+        watcher.viewers -= 1
+        if watcher.viewers == 0:
+            watcher.close()
+            del self.watchers[id(source)]
+
+    async def handle(self, reader, writer):
+        try:
+            # Reads the request line and the headers
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            headers = dict()
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 10)
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            parts = request_line.decode('latin-1').split()
+            url = urlsplit(parts[1]) if len(parts) == 3 else None
+            match = route_pattern.match(url.path) if url is not None and parts[0] == 'GET' else None
+            session = self.sessions.get(match.group(2)) if match is not None else None
+            if session is None or session.stream.camera is None:
+                await self.not_found(writer)
+                return
+
+            query = parse_qs(url.query)
+            feed = match.group(1)
+            if feed == 'video_feed' or feed == 'image_feed':
+                profile = query.get('profile', [None])[0]
+                stream = self.feed(writer, session, 0 if feed == 'video_feed' else 1, profile)
+            elif feed == 'avatar_events':
+                # The teacher sessions have no avatar
+                if not hasattr(session.stream.camera, 'avatar_state'):
+                    await self.not_found(writer)
+                    return
+                stream = self.states(writer, session)
+            else:
+                board = session.stream.camera
+                if not hasattr(board, 'board_log'):
+                    await self.not_found(writer)
+                    return
+                # Browsers reconnect with the id of the last event received
+                since = headers.get('last-event-id', query.get('since', ['0'])[0])
+                stream = self.board(writer, session, board, int(since) if since.isdigit() else 0)
+
+            # Streams until the viewer disconnects or the session stops
+            streaming = asyncio.ensure_future(stream)
+            closed = asyncio.ensure_future(self.wait_closed(reader))
+            done, pending = await asyncio.wait((streaming, closed), return_when=asyncio.FIRST_COMPLETED)
+            for task in pending:
+                task.cancel()
+            # The errors of the disconnected viewers are expected
+            await asyncio.gather(*done, *pending, return_exceptions=True)
+        except (ConnectionError, asyncio.TimeoutError, UnicodeDecodeError):
+            pass
+        finally:
+            writer.close()
+
+    async def not_found(self, writer):
+        writer.write(b'HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n')
+        await writer.drain()
+
+    async def wait_closed(self, reader):
+        # Returns when the viewer closes the connection
+        while await reader.read(4096):
+            pass
+
+    async def feed(self, writer, session, index, profile):
+        # Streams one of the images (0: webcam frame, 1: processed image) of the latest frame processed by the session
+        stream = session.stream
+        labels = {'pipeline': stream.name, 'feed': ('video', 'image')[index]}
+        writer.write(feed_headers)
+        registry.add('vedar_viewers', 1, **labels)
+        session.connect()
+        watcher = self.watch(stream)
+        # Encoding profile of the viewer, chosen from how fast it receives the frames unless one is requested
+        selector = ProfileSelector(profile)
+        try:
+            seq = 0
+            last_key = None
+            while stream.running:
+                frame = stream.frame
+                if frame is None or frame.seq <= seq:
+                    await watcher.wait(1.0)
+                    continue
+                # Counts the frames the viewer skipped because it was slower than the pipeline or its profile
+                if seq:
+                    registry.inc('vedar_frames_dropped_total', frame.seq - seq - 1, **labels)
+                seq = frame.seq
+
+                # Skips the images identical to the last one sent
+                if frame.keys[index] == last_key:
+                    continue
+                last_key = frame.keys[index]
+
+                # The image is encoded once per profile outside the event loop and shared by all the viewers
+                jpeg = await self.loop.run_in_executor(None, frame.encode, index, selector.profile)
+                started = time.perf_counter()
+                writer.write(b'--frame\r\nContent-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n\r\n')
+                await writer.drain()
+                selector.observe(time.perf_counter() - started)
+                delay = selector.delay()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+        finally:
+            # The viewer disconnected or the stream stopped
+            self.unwatch(stream)
+            registry.add('vedar_viewers', -1, **labels)
+            session.disconnect()
+
+    async def send_event(self, writer, text):
+        writer.write(text.encode('utf-8'))
+        await writer.drain()
+
+    async def states(self, writer, session):
+        # Streams a server-sent event with the avatar state every time it changes
+        stream = session.stream
+        labels = {'pipeline': stream.name, 'feed': 'avatar_events'}
+        writer.write(event_headers)
+        registry.add('vedar_viewers', 1, **labels)
+        session.connect()
+        watcher = self.watch(stream)
+        try:
+            state = None
+            last_sent = time.monotonic()
+            while stream.running:
+                if stream.state != state:
+                    state = stream.state
+                    await self.send_event(writer, 'event: avatar\ndata: %s\n\n' % state)
+                    last_sent = time.monotonic()
+                elif time.monotonic() - last_sent >= keepalive_interval:
+                    # Keeps the connection alive while the avatar does not change
+                    await self.send_event(writer, ': keepalive\n\n')
+                    last_sent = time.monotonic()
+                else:
+                    await watcher.wait(keepalive_interval)
+        finally:
+            self.unwatch(stream)
+            registry.add('vedar_viewers', -1, **labels)
+            session.disconnect()
+
+    async def board(self, writer, session, board, since):
+        # Streams the changes of the board as server-sent events, starting after the given sequence number
+        stream = session.stream
+        board_log = board.board_log
+        labels = {'pipeline': stream.name, 'feed': 'board_events'}
+        writer.write(event_headers)
+        registry.add('vedar_viewers', 1, **labels)
+        session.connect()
+        watcher = self.watch(board_log)
+        try:
+            # Sends the colors of the board in RGB so the clients can draw the strokes
+            colors = ['#%02x%02x%02x' % (r, g, b) for (b, g, r) in board.colors]
+            await self.send_event(writer, 'event: colors\ndata: %s\n\n' % dumps(colors))
+
+            last_sent = time.monotonic()
+            while stream.running:
+                events = board_log.read(since, 0)
+                if events is None:
+                    # The viewer fell too far behind and has to load a new snapshot
+                    since = board_log.seq
+                    await self.send_event(writer, 'event: reset\ndata: %d\n\n' % since)
+                elif events:
+                    since = events[-1]['seq']
+                    await self.send_event(writer, ''.join('id: %d\nevent: board\ndata: %s\n\n' % (
+                        event['seq'], dumps(event)) for event in events))
+                elif time.monotonic() - last_sent >= keepalive_interval:
+                    # Keeps the connection alive while the board does not change
+                    await self.send_event(writer, ': keepalive\n\n')
+                else:
+                    # A stopped session is noticed at the latest with the next keepalive
+                    await watcher.wait(keepalive_interval)
+                    continue
+                last_sent = time.monotonic()
+        finally:
+            self.unwatch(board_log)
+            registry.add('vedar_viewers', -1, **labels)
+            session.disconnect()
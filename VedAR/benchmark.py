@@ -0,0 +1,136 @@
+import argparse
+import json
+import platform
+import resource
+import sys
+import time
+import tracemalloc
+from datetime import datetime
+
+import cv2
+import numpy as np
+
+from camera import VideoCamera
+from camboard import VideoCameraBoard
+from sources import open_source
+
+# Pipelines that can be benchmarked
+pipelines = {
+    'student': VideoCamera,
+    'student-parallel': lambda source: VideoCamera(source, parallel=True),
+    'board': VideoCameraBoard,
+}
+
+
+# Replays the frames of a source through a pipeline and returns the latency of each frame in seconds
+def measure_latency(pipeline, source, frames, warmup):
+    camera = pipelines[pipeline](open_source(source))
+    latencies = list()
+    for i in range(warmup + frames):
+        started = time.perf_counter()
+        camera.get_frame()
+        # The warmup frames are not counted
+        if i >= warmup:
+            latencies.append(time.perf_counter() - started)
+    return latencies
+
+
+# Replays the frames of a source through a pipeline and returns the peak of memory allocated in bytes
+def measure_memory(pipeline, source, frames):
+    tracemalloc.start()
+    camera = pipelines[pipeline](open_source(source))
+    for i in range(frames):
+        camera.get_frame()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak
+
+
+# Runs the benchmark of a pipeline with a source and returns a Dictionary with the results
+def run_benchmark(pipeline, source, frames, warmup, memory):
+    latencies = np.array(measure_latency(pipeline, source, frames, warmup)) * 1000
+    result = {
+        'pipeline': pipeline,
+        'source': source,
+        'frames': frames,
+        'fps': round(frames / (latencies.sum() / 1000), 2),
+        'latency_ms': {
+            'mean': round(float(latencies.mean()), 3),
+            'p50': round(float(np.percentile(latencies, 50)), 3),
+            'p90': round(float(np.percentile(latencies, 90)), 3),
+            'p99': round(float(np.percentile(latencies, 99)), 3),
+            'max': round(float(latencies.max()), 3),
+        },
+    }
+    # The memory is measured in a second replay so the tracing does not affect the latency
+    if memory:
+        result['peak_memory_mb'] = round(measure_memory(pipeline, source, frames) / 2 ** 20, 3)
+    return result
+
+
+# Compares the results with a previous benchmark file and returns the List of regressions found
+def compare(results, baseline_file, tolerance):
+    with open(baseline_file) as f:
+        baseline = json.load(f)
+    previous = {(r['pipeline'], r['source']): r for r in baseline['results']}
+
+    regressions = list()
+    for result in results:
+        old = previous.get((result['pipeline'], result['source']))
+        if old is None:
+            continue
+        # The FPS must not drop and the p99 latency must not grow more than the tolerance
+        if result['fps'] < old['fps'] * (1 - tolerance):
+            regressions.append('%s %s: fps %.2f -> %.2f' % (result['pipeline'], result['source'], old['fps'], result['fps']))
+        if result['latency_ms']['p99'] > old['latency_ms']['p99'] * (1 + tolerance):
+            regressions.append('%s %s: p99 %.3f ms -> %.3f ms' % (result['pipeline'], result['source'],
+                                                                old['latency_ms']['p99'], result['latency_ms']['p99']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Replays fixed clips through the VedAR video pipelines')
+    parser.add_argument('--source', action='append',
+                        help="frame source: 'synthetic', 'video:clip.mp4' or 'images:directory' (can be repeated)")
+    parser.add_argument('--pipeline', action='append', choices=sorted(pipelines),
+                        help='pipeline to benchmark (can be repeated, all by default)')
+    parser.add_argument('--frames', type=int, default=300, help='frames measured by run')
+    parser.add_argument('--warmup', type=int, default=10, help='frames processed before measuring')
+    parser.add_argument('--no-memory', action='store_true', help='skip the peak memory replay')
+    parser.add_argument('--output', default='benchmark.json', help='JSON file where the results are written')
+    parser.add_argument('--baseline', help='previous JSON results to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='allowed relative regression against the baseline')
+    args = parser.parse_args()
+
+    # Runs every pipeline with every source
+    results = list()
+    for pipeline in args.pipeline or sorted(pipelines):
+        for source in args.source or ['synthetic']:
+            result = run_benchmark(pipeline, source, args.frames, args.warmup, not args.no_memory)
+            results.append(result)
+            print('%-16s %-30s %8.2f fps  p50 %7.3f ms  p99 %7.3f ms' % (
+                pipeline, source, result['fps'], result['latency_ms']['p50'], result['latency_ms']['p99']))
+
+    # Writes the machine readable results
+    report = {
+        'created_at': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'opencv': cv2.__version__,
+        'machine': platform.machine(),
+        'max_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 3),
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    # Fails if the results are worse than the baseline
+    if args.baseline:
+        regressions = compare(results, args.baseline, args.tolerance)
+        for regression in regressions:
+            print('REGRESSION ' + regression)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
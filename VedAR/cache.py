@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict
+from metrics import registry
+from dbase import messages_page_size
+
+
+# LRUCache object that keeps the last values loaded, each one for a limited time
+class LRUCache(object):
+    def __init__(self, name, max_entries=1024, ttl=60.0):
+        # Name of the cache in the metrics, maximum values kept and seconds each value is valid
+        self.name = name
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+
+        # Values and expiration times by key, from the least to the most recently used
+        self.entries = OrderedDict()
+        # Changes with every invalidation, so the values loaded before it are not stored
+        self.version = 0
+
+    def get(self, key, load):
+        # Returns the value of the key, loading it if it is not cached or expired
+        # The first item of the key labels the metrics
+        now = time.monotonic()
+        with self.lock:
+            entry = self.entries.get(key)
+            hit = entry is not None and entry[1] > now
+            if hit:
+                self.entries.move_to_end(key)
+            version = self.version
+        if hit:
+            registry.inc('vedar_cache_hits_total', cache=self.name, kind=key[0])
+            return entry[0]
+
+        registry.inc('vedar_cache_misses_total', cache=self.name, kind=key[0])
+        value = load()
+        with self.lock:
+            if self.version == version:
+                self.entries[key] = (value, now + self.ttl)
+                self.entries.move_to_end(key)
+                # Drops the least recently used values
+                while len(self.entries) > self.max_entries:
+                    self.entries.popitem(last=False)
+                    registry.inc('vedar_cache_evictions_total', cache=self.name)
+        return value
+
+    def invalidate(self, match):
+        # Removes the values whose key matches
+        with self.lock:
+            self.version += 1
+            for key in [key for key in self.entries if match(key)]:
+                del self.entries[key]
+
+
+# CachedDatabase object that caches the reads of the user pages in front of a Database() object
+# Every write removes the cached values it changes
+class CachedDatabase(object):
+    def __init__(self, database, max_entries=1024, ttl=60.0):
+        self.database = database
+        # Values by (kind, email, arguments)
+        self.cache = LRUCache('database', max_entries, ttl)
+
+    def __getattr__(self, name):
+        # The methods that are not cached go straight to the database
+        return getattr(self.database, name)
+
+    def invalidate(self, email, *kinds):
+        # Removes the values of a user, only of the given kinds if any, or of every user if the email is None
+        self.cache.invalidate(lambda key: (email is None or key[1] == email) and (not kinds or key[0] in kinds))
+
+    def search_by_email(self, email):
+        return self.cache.get(('user', email), lambda: self.database.search_by_email(email))
+
+    def search_friends_by_email(self, email):
+        return self.cache.get(('friends', email), lambda: self.database.search_friends_by_email(email))
+
+    def recover_messages(self, email, before=None, limit=messages_page_size):
+        return self.cache.get(('messages', email, before, limit),
+                              lambda: self.database.recover_messages(email, before, limit))
+
+    def create_user(self, username, email, role, institution, password):
+        self.database.create_user(username, email, role, institution, password)
+        # The registration pages cache the missing user
+        self.invalidate(email)
+
+    def save_changes(self, email, username, institution, role, about):
+        self.database.save_changes(email, username, institution, role, about)
+        # The username is also shown in the friends and messages of other users
+        self.invalidate(email)
+        self.invalidate(None, 'friends', 'messages')
+
+    def add_friend(self, email, friend_email):
+        errors = self.database.add_friend(email, friend_email)
+        self.invalidate(email, 'friends')
+        return errors
+
+    def send_message(self, email, friend_email, message):
+        errors = self.database.send_message(email, friend_email, message)
+        # The message is in the inbox of the friend
+        self.invalidate(friend_email, 'messages')
+        return errors
+
+    def add_session(self, email):
+        result = self.database.add_session(email)
+        # The user data includes the count of sessions
+        self.invalidate(email, 'user')
+        return result
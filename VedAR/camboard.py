@@ -1,131 +1,257 @@
+import threading
 import numpy as np
 import cv2
-from collections import deque
+from sources import DeviceSource
+from strokes import StrokeStore, BoardLog
+from metrics import StageTimer
+
+
+# Function to draw the coloring options over an image and its mask
+def draw_palette(image, mask, colors, clear_color):
+    for (x0, x1), color in zip(((160, 255), (275, 370), (390, 485), (505, 600)), colors):
+        cv2.rectangle(image, (x0, 1), (x1, 65), color, -1)
+        cv2.rectangle(mask, (x0, 1), (x1, 65), 255, -1)
+    cv2.rectangle(image, (40, 1), (140, 65), (0, 0, 0), 2)
+    cv2.rectangle(mask, (40, 1), (140, 65), 255, 2)
+
+    for text, position, color in (("Limpiar", (49, 33), clear_color), ("Azul", (185, 33), (255, 255, 255)),
+                                  ("Verde", (298, 33), (255, 255, 255)), ("Rojo", (420, 33), (255, 255, 255)),
+                                  ("Amarillo", (517, 33), (0, 0, 0))):
+        cv2.putText(image, text, position, cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 2, cv2.LINE_AA)
+        cv2.putText(mask, text, position, cv2.FONT_HERSHEY_SIMPLEX, 0.5, 255, 2, cv2.LINE_AA)
+
+
+# PenTracker object that finds the pen color in a downscaled image, searching first around its last position
+class PenTracker(object):
+    def __init__(self, lower, upper, scale=0.5, window=120):
+        # Define the upper and lower HSV boundaries for a color to be considered the pen color.
+        self.set_bounds(lower, upper)
+        # Resize factor of the searched image and half size of the search window in frame pixels
+        self.scale = scale
+        self.window = window
+        # Define a kernel for erosion and dilation equivalent to a 5x5 kernel at full resolution.
+        size = max(int(round(5 * scale)), 1)
+        self.kernel = np.ones((size, size), np.uint8)
+
+        # Last center of the pen, None when it is lost
+        self.last = None
+
+    def set_bounds(self, lower, upper):
+        self.lower = np.array(lower)
+        self.upper = np.array(upper)
+
+    def find(self, frame):
+        # Returns the center of the pen and its enclosing circle ((x, y), radius), or None if it is not found
+        result = None
+        if self.last is not None:
+            # Searches in a window around the last position
+            x, y = self.last
+            result = self.search(frame, max(x - self.window, 0), max(y - self.window, 0),
+                                 min(x + self.window, frame.shape[1]), min(y + self.window, frame.shape[0]))
+        if result is None:
+            # Searches the whole frame when the pen was lost
+            result = self.search(frame, 0, 0, frame.shape[1], frame.shape[0])
+
+        self.last = result[0] if result is not None else None
+        return result
+
+    def search(self, frame, x0, y0, x1, y1):
+        # Downscales the region [y0:y1, x0:x1] of the frame
+        region = cv2.resize(frame[y0:y1, x0:x1], None, fx=self.scale, fy=self.scale, interpolation=cv2.INTER_NEAREST)
+        hsv = cv2.cvtColor(region, cv2.COLOR_BGR2HSV)
+
+        # Determine which pixels fall within the boundaries and then blur the binary image.
+        mask = cv2.inRange(hsv, self.lower, self.upper)
+        mask = cv2.erode(mask, self.kernel, iterations=2)
+        mask = cv2.morphologyEx(mask, cv2.MORPH_OPEN, self.kernel)
+        mask = cv2.dilate(mask, self.kernel, iterations=1)
+
+        # Find contours in the image.
+        (cnts, _) = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+        if len(cnts) == 0:
+            return None
+
+        # Find the largest contour -- we
+        #   will assume this contour correspondes to the area of the bottle cap.
+        cnt = max(cnts, key=cv2.contourArea)
+        # Get the moments to calculate the center of the contour (in this case Circle).
+        M = cv2.moments(cnt)
+        if M['m00'] == 0:
+            return None
+        # Get the radius of the enclosing circle around the found contour.
+        ((x, y), radius) = cv2.minEnclosingCircle(cnt)
+
+        # Returns the values in the coordinates of the full frame
+        center = (int(M['m10'] / M['m00'] / self.scale) + x0, int(M['m01'] / M['m00'] / self.scale) + y0)
+        circle = ((int(x / self.scale) + x0, int(y / self.scale) + y0), int(radius / self.scale))
+        return center, circle
 
 
 # VideoCameraBoard object that controls all the recognition and board changes
 class VideoCameraBoard(object):
-    def __init__(self):
-        # Capturing video
-        self.video = cv2.VideoCapture(0)
-
-        # Define the upper and lower boundaries for a color to be considered "Blue".
-        self.blueLower = np.array([100, 60, 60])
-        self.blueUpper = np.array([140, 255, 255])
-
-        # Define a 5x5 kernel for erosion and dilation.
-        self.kernel = np.ones((5, 5), np.uint8)
-
-        # Setup deques to store separate colors in separate arrays.
-        self.bpoints = [deque(maxlen=512)]
-        self.gpoints = [deque(maxlen=512)]
-        self.rpoints = [deque(maxlen=512)]
-        self.bindex = 0
-        self.gindex = 0
-        self.rindex = 0
-        self.colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255)]
+    # Name of the pipeline in the metrics
+    name = 'board'
+
+    def __init__(self, source=None, max_points=20000, lower=(100, 60, 60), upper=(140, 255, 255)):
+        # Capturing video from the given frame source or the local webcam
+        self.video = source if source is not None else DeviceSource(0)
+
+        # Tracker of the pen, "Blue" by default
+        self.pen = PenTracker(lower, upper)
+
+        # Setup the store of the strokes with their color index (blue, green, red and yellow).
+        self.strokes = StrokeStore(max_points)
+        self.colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (0, 255, 255)]
         self.colorIndex = 0
+        # Log of the board changes sent to the viewers and lock of the board shared with the snapshots
+        self.board_log = BoardLog()
+        self.lock = threading.Lock()
 
         # Setup the paint interface.
-        self.paintWindow = np.zeros((471, 636, 3)) + 255
-        self.paintWindow = cv2.rectangle(self.paintWindow, (40, 1), (140, 65), (0, 0, 0), 2)
-        self.paintWindow = cv2.rectangle(self.paintWindow, (160, 1), (255, 65), self.colors[0], -1)
-        self.paintWindow = cv2.rectangle(self.paintWindow, (275, 1), (370, 65), self.colors[1], -1)
-        self.paintWindow = cv2.rectangle(self.paintWindow, (390, 1), (485, 65), self.colors[2], -1)
-        cv2.putText(self.paintWindow, "Limpiar", (49, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (0, 0, 0), 2, cv2.LINE_AA)
-        cv2.putText(self.paintWindow, "Azul", (185, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-        cv2.putText(self.paintWindow, "Verde", (298, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-        cv2.putText(self.paintWindow, "Rojo", (420, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
+        self.paintWindow = np.full((471, 636, 3), 255, np.uint8)
+        draw_palette(self.paintWindow, np.zeros((471, 636), np.uint8), self.colors, (0, 0, 0))
+        # Copy and encoded paint interface, they are created again only when it changes
+        self.paint_image = None
+        self.paint_jpeg = None
+
+        # Layers composited over the camera frames, created with the size of the first frame
+        # The overlay has the coloring options and every stroke drawn, the mask marks its drawn pixels
+        self.palette = None
+        self.palette_mask = None
+        self.overlay = None
+        self.overlay_mask = None
+
+        # Timer of the pipeline stages
+        self.timer = StageTimer(self.name)
 
     def __del__(self):
-        # Releasing camera
+        # Releasing the frame source
         self.video.release()
 
-    def get_frame(self):
-        # Extracting frames
-        ret, frame = self.video.read()
-        frame = cv2.flip(frame, 1)
-        hsv = cv2.cvtColor(frame, cv2.COLOR_BGR2HSV)
-
-        # Add the coloring options to the frame.
-        frame = cv2.rectangle(frame, (40, 1), (140, 65), (0, 0, 0), 2)
-        frame = cv2.rectangle(frame, (160, 1), (255, 65), self.colors[0], -1)
-        frame = cv2.rectangle(frame, (275, 1), (370, 65), self.colors[1], -1)
-        frame = cv2.rectangle(frame, (390, 1), (485, 65), self.colors[2], -1)
-        cv2.putText(frame, "Limpiar", (49, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-        cv2.putText(frame, "Azul", (185, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-        cv2.putText(frame, "Verde", (298, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-        cv2.putText(frame, "Rojo", (420, 33), cv2.FONT_HERSHEY_SIMPLEX, 0.5, (255, 255, 255), 2, cv2.LINE_AA)
-
-        # Determine which pixels fall within the blue boundaries and then blur the binary image.
-        blueMask = cv2.inRange(hsv, self.blueLower, self.blueUpper)
-        blueMask = cv2.erode(blueMask, self.kernel, iterations=2)
-        blueMask = cv2.morphologyEx(blueMask, cv2.MORPH_OPEN, self.kernel)
-        blueMask = cv2.dilate(blueMask, self.kernel, iterations=1)
-        # Find contours in the image.
-        (cnts, _) = cv2.findContours(blueMask.copy(), cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
-        center = None
-
-        # Check to see if any contours were found.
-        if len(cnts) > 0:
-            # Sort the contours and find the largest one -- we
-            #   will assume this contour correspondes to the area of the bottle cap.
-            cnt = sorted(cnts, key=cv2.contourArea, reverse=True)[0]
-            # Get the radius of the enclosing circle around the found contour.
-            ((x, y), radius) = cv2.minEnclosingCircle(cnt)
-            # Draw the circle around the contour.
-            cv2.circle(frame, (int(x), int(y)), int(radius), (0, 255, 255), 2)
-            # Get the moments to calculate the center of the contour (in this case Circle).
-            M = cv2.moments(cnt)
-            center = (int(M['m10'] / M['m00']), int(M['m01'] / M['m00']))
+    def setup_layers(self, shape):
+        # Pre-renders the coloring options once
+        self.palette = np.zeros(shape, np.uint8)
+        self.palette_mask = np.zeros(shape[:2], np.uint8)
+        draw_palette(self.palette, self.palette_mask, self.colors, (255, 255, 255))
+
+        # The strokes layer starts with just the coloring options and the strokes stored
+        self.clear_layers()
+        self.strokes.render(self.overlay, self.colors)
+        self.strokes.render(self.overlay_mask, [255] * len(self.colors))
+
+    def clear_layers(self):
+        self.overlay = self.palette.copy()
+        self.overlay_mask = self.palette_mask.copy()
+
+    def draw_segment(self, start, end, color):
+        # Draws just the new segment in the persistent layers
+        cv2.line(self.overlay, start, end, color, 2)
+        cv2.line(self.overlay_mask, start, end, 255, 2)
+        cv2.line(self.paintWindow, start, end, color, 2)
+        self.paint_image = None
+        self.paint_jpeg = None
+
+    def add_point(self, center):
+        # Joins the new point with the last point of the stroke
+        previous = self.strokes.add_point(center, self.colorIndex)
+        if previous is not None:
+            self.draw_segment(previous, center, self.colors[self.colorIndex])
+        self.board_log.add('point', x=center[0], y=center[1], color=self.colorIndex, new=previous is None)
+
+    def end_stroke(self):
+        # Ends the stroke being drawn, if any
+        if self.strokes.current is not None:
+            self.strokes.end_stroke()
+            self.board_log.add('end')
+
+    def select_color(self, index):
+        if index != self.colorIndex:
+            self.colorIndex = index
+            self.board_log.add('color', color=index)
+
+    def clear(self):
+        self.strokes.clear()
+        self.paintWindow[67:, :, :] = 255
+        self.paint_image = None
+        self.paint_jpeg = None
+        self.clear_layers()
+        self.board_log.add('clear')
+
+    def encode_board(self):
+        # Encodes the paint interface only if it changed
+        if self.paint_jpeg is None:
+            ret, paint = cv2.imencode('.jpg', self.paintWindow)
+            self.paint_jpeg = paint.tobytes()
+        return self.paint_jpeg
+
+    def snapshot(self):
+        # Returns the encoded paint interface with the sequence number of the last change it includes
+        with self.lock:
+            return self.board_log.seq, self.encode_board()
+
+    def update_board(self, pen):
+        # Check to see if the pen was found.
+        if pen is not None:
+            center = pen[0]
             if center[1] <= 65:
                 if 40 <= center[0] <= 140:  # Clear All.
-                    self.bpoints = [deque(maxlen=512)]
-                    self.gpoints = [deque(maxlen=512)]
-                    self.rpoints = [deque(maxlen=512)]
-                    ypoints = [deque(maxlen=512)]
-                    self.bindex = 0
-                    self.gindex = 0
-                    self.rindex = 0
-                    yindex = 0
-                    self.paintWindow[67:, :, :] = 255
+                    self.clear()
                 elif 160 <= center[0] <= 255:
-                    self.colorIndex = 0  # Blue.
+                    self.select_color(0)  # Blue.
                 elif 275 <= center[0] <= 370:
-                    self.colorIndex = 1  # Green.
+                    self.select_color(1)  # Green.
                 elif 390 <= center[0] <= 485:
-                    self.colorIndex = 2  # Red.
+                    self.select_color(2)  # Red.
                 elif 505 <= center[0] <= 600:
-                    self.colorIndex = 3  # Yellow.
+                    self.select_color(3)  # Yellow.
             else:
-                if self.colorIndex == 0:
-                    self.bpoints[self.bindex].appendleft(center)
-                elif self.colorIndex == 1:
-                    self.gpoints[self.gindex].appendleft(center)
-                elif self.colorIndex == 2:
-                    self.rpoints[self.rindex].appendleft(center)
-        # Append the next deque when no contours are detected (i.e., pencil reversed).
+                self.add_point(center)
+        # End the stroke when no contours are detected (i.e., pencil reversed).
         else:
-            self.bpoints.append(deque(maxlen=512))
-            self.bindex += 1
-            self.gpoints.append(deque(maxlen=512))
-            self.gindex += 1
-            self.rpoints.append(deque(maxlen=512))
-            self.rindex += 1
-        # Draw lines of all the colors.
-        points = [self.bpoints, self.gpoints, self.rpoints]
-        for i in range(len(points)):
-            for j in range(len(points[i])):
-                for k in range(1, len(points[i][j])):
-                    if points[i][j][k - 1] is None or points[i][j][k] is None:
-                        continue
-                    cv2.line(frame, points[i][j][k - 1], points[i][j][k], self.colors[i], 2)
-                    cv2.line(self.paintWindow, points[i][j][k - 1], points[i][j][k], self.colors[i], 2)
-
-        # Encode OpenCV raw frame and processed image to jpg
+            self.end_stroke()
+
+    def get_frame(self):
+        # Processes a frame and encodes the raw frame to jpg, the paint interface is encoded again only if it changed
+        frame, _, _ = self.process()
         ret, jpeg = cv2.imencode('.jpg', frame)
-        ret, paint = cv2.imencode('.jpg', self.paintWindow)
+        seq, paint = self.snapshot()
 
         # Return the encoded images in byte format
-        return jpeg.tobytes(), paint.tobytes()
+        return jpeg.tobytes(), paint
+
+    def process(self):
+        # Extracting frames
+        self.timer.start()
+        ret, frame = self.video.read()
+        self.timer.mark('read')
+        frame = cv2.flip(frame, 1)
+        if self.overlay is None or self.overlay.shape != frame.shape:
+            self.setup_layers(frame.shape)
+        self.timer.mark('preprocess')
+
+        # Find the pen in the frame.
+        pen = self.pen.find(frame)
+        self.timer.mark('pen_search')
+
+        # Updates the board with the pen position.
+        with self.lock:
+            self.update_board(pen)
+        self.timer.mark('pen')
+
+        # Copies the coloring options and the strokes over the frame in a single masked copy
+        cv2.copyTo(self.overlay, self.overlay_mask, frame)
+        # Draw the circle around the contour.
+        if pen is not None:
+            (x, y), radius = pen[1]
+            cv2.circle(frame, (x, y), radius, (0, 255, 255), 2)
+        self.timer.mark('strokes')
+
+        # Copies the paint interface only if it changed, so it can be encoded while the board keeps changing
+        with self.lock:
+            if self.paint_image is None:
+                self.paint_image = self.paintWindow.copy()
+            paint, seq = self.paint_image, self.board_log.seq
+        self.timer.stop()
 
+        # Return the raw frame, the paint interface and the sequence number of the last board change
+        return frame, paint, seq
@@ -1,57 +1,236 @@
 import cv2
 import numpy as np
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from sources import DeviceSource
+from metrics import StageTimer
 
-# Function to display the avatar with the corresponding icon
-def display_icon(icon_file):
+# Function to render the avatar with the corresponding icon
+def render_avatar(icon_file):
+    avatar = avatar_img.copy()
     # Background color
     bb = np.zeros((icon_height, icon_width, 3), np.uint8)
-    bb[:] = [blue, green, red]
+    bb[:] = avatar_img[0, 0]
 
     if icon_file is None:
-        icon_img[0:icon_height, 0:icon_width] = bb
+        avatar[0:icon_height, 0:icon_width] = bb
     else:
         icon = cv2.imread(icon_file)
         icon = cv2.resize(icon, (icon_width, icon_height))
         # Overlap the background with the icon
         icon = cv2.addWeighted(icon, 0.7, bb, 0.3, 0)
         # Replace icon in the avatar coordinates [y:y+h, x:x+w]
-        icon_img[0:icon_height, 0:icon_width] = icon
+        avatar[0:icon_height, 0:icon_width] = icon
 
-    return icon_img
+    return avatar
+
+
+# Runs a cascade over the gray image scaled by the given resolution
+# Returns the boxes in the coordinates of the original gray image
+def detect_scaled(cascade, gray, resolution, params):
+    if resolution == 1.0:
+        return cascade.detectMultiScale(gray, **params)
+
+    small = cv2.resize(gray, None, fx=resolution, fy=resolution, interpolation=cv2.INTER_AREA)
+    boxes = cascade.detectMultiScale(small, **params)
+    return [tuple(int(v / resolution) for v in box) for box in boxes]
 
 
 # Defining all variables
 
-# Defining face, smile, palm and fist detectors
-face_cascade = cv2.CascadeClassifier("haarcascades/haarcascade_frontalface_default.xml")
-smile_cascade = cv2.CascadeClassifier('haarcascades/haarcascade_smile.xml')
-open_palm_cascade = cv2.CascadeClassifier('haarcascades/open_palm.xml')
-closed_palm_cascade = cv2.CascadeClassifier('haarcascades/closed_palm.xml')
+# Defining face, smile, palm and fist detector files
+cascade_files = {
+    'face': 'haarcascades/haarcascade_frontalface_default.xml',
+    'smile': 'haarcascades/haarcascade_smile.xml',
+    'palm': 'haarcascades/open_palm.xml',
+    'fist': 'haarcascades/closed_palm.xml',
+}
 
 # Frame resize factor
 ds_factor = 0.6
 
+# Base scale factor, minimum neighbors and size bounds (relative to the face size) of each cascade
+cascade_params = {
+    'face': (1.2, 5, 0.6, 1.6),
+    'palm': (1.1, 12, 0.5, 2.0),
+    'fist': (1.1, 10, 0.4, 1.6),
+}
+# Scale factor added to every cascade by each load level
+load_step = 0.05
+max_load_level = 4
+
+# Thread pool shared by all the cameras to run the detectors concurrently
+# OpenCV releases the GIL during detectMultiScale, so the detectors run in parallel
+detector_pool = ThreadPoolExecutor(max_workers=min(8, os.cpu_count() or 1), thread_name_prefix='detector')
+
 # Defining the image variables
 icon_width = 85
 icon_height = 75
-sleep = 'images/sleep.png'
-hand = 'images/hand.png'
-thumbUp = 'images/thumb-up.png'
-thumbDown = 'images/thumb-down.png'
+avatar_img = cv2.imread('images/animal-icon-cat.jpg')
+
+# Event stored for the call when the avatar changes to each state
+state_events = {
+    'sleep': 'sleep',
+    'hand': 'raise_hand',
+    'thumb_up': 'agree',
+    'thumb_down': 'disagree',
+}
+
+# Icon of each avatar state
+avatar_icons = {
+    'neutral': None,
+    'sleep': 'images/sleep.png',
+    'hand': 'images/hand.png',
+    'thumb_up': 'images/thumb-up.png',
+    'thumb_down': 'images/thumb-down.png',
+}
+
+
+# AvatarCache object that renders and encodes every avatar state just once
+class AvatarCache(object):
+    def __init__(self):
+        # Image and jpg bytes of each avatar state
+        self.images = dict()
+        self.jpegs = dict()
+        for state, icon_file in avatar_icons.items():
+            self.images[state] = render_avatar(icon_file)
+            ret, jpeg = cv2.imencode('.jpg', self.images[state])
+            self.jpegs[state] = jpeg.tobytes()
+
+
+# Avatars shared by all the cameras
+avatar_cache = AvatarCache()
+
+
+# Cascades object that loads the face, smile, palm and fist detectors of a camera
+# detectMultiScale changes the state of its classifier, so the cameras running at the same time cannot share them
+class Cascades(object):
+    def __init__(self):
+        self.face = cv2.CascadeClassifier(cascade_files['face'])
+        self.smile = cv2.CascadeClassifier(cascade_files['smile'])
+        self.palm = cv2.CascadeClassifier(cascade_files['palm'])
+        self.fist = cv2.CascadeClassifier(cascade_files['fist'])
+
+
+# AdaptiveParams object that derives the cascade parameters from the recent detections and the frame load
+class AdaptiveParams(object):
+    def __init__(self, target_fps=15, resolutions=None, cooldown=15):
+        # Frames per second the pipeline tries to hold
+        self.target_fps = target_fps
+        # Processing resolution of each cascade, relative to the resized frame
+        self.resolutions = resolutions or {'face': 1.0, 'palm': 0.75, 'fist': 0.75}
+        # Minimum frames between load level changes
+        self.cooldown = cooldown
+
+        # Widths of the last faces detected and frames without a face
+        self.face_sizes = deque(maxlen=30)
+        self.missed_faces = 0
+        # Load level, smoothed frame time and frames since the last level change
+        self.load_level = 0
+        self.frame_time = 0.0
+        self.frames_since_change = 0
+
+    def observe_faces(self, faces):
+        if len(faces) > 0:
+            self.face_sizes.append(faces[0][2])
+            self.missed_faces = 0
+        else:
+            # Forgets the size bounds when the face is lost for a while, so any face size can be found again
+            self.missed_faces += 1
+            if self.missed_faces >= self.cooldown:
+                self.face_sizes.clear()
 
-# Icon image and color streams
-icon_img = cv2.imread('images/animal-icon-cat.jpg')
-img = cv2.imread('images/animal-icon-cat.jpg')
-blue = icon_img[0, 0, 0]
-green = icon_img[0, 0, 1]
-red = icon_img[0, 0, 2]
+    def observe_frame(self, seconds):
+        # Smoothed time of the frames
+        self.frame_time = 0.9 * self.frame_time + 0.1 * seconds if self.frame_time else seconds
+        self.frames_since_change += 1
+        if self.frames_since_change < self.cooldown:
+            return
+
+        # Uses bigger pyramid steps when the frames take longer than the target and smaller ones when there is time left
+        budget = 1.0 / self.target_fps
+        if self.frame_time > budget * 1.1 and self.load_level < max_load_level:
+            self.load_level += 1
+            self.frames_since_change = 0
+        elif self.frame_time < budget * 0.7 and self.load_level > 0:
+            self.load_level -= 1
+            self.frames_since_change = 0
+
+    def get(self, cascade):
+        # Returns the processing resolution and the detectMultiScale parameters of the cascade
+        scale, neighbors, min_size, max_size = cascade_params[cascade]
+        resolution = self.resolutions.get(cascade, 1.0)
+        params = {'scaleFactor': scale + load_step * self.load_level, 'minNeighbors': neighbors}
+
+        # Bounds the searched sizes with the median size of the recent faces
+        if self.face_sizes:
+            size = float(np.median(self.face_sizes)) * resolution
+            params['minSize'] = (int(size * min_size), int(size * min_size))
+            params['maxSize'] = (int(size * max_size), int(size * max_size))
+
+        return resolution, params
+
+
+# FaceTracker object that schedules the full frame face detection and follows the face between detections
+class FaceTracker(object):
+    def __init__(self, cascade, params, detect_interval=5, margin=0.5):
+        # Face detector of the camera and parameters of the full frame detection
+        self.cascade = cascade
+        self.params = params
+        # Frames between full frame detections
+        self.detect_interval = detect_interval
+        # Size of the search window around the last face, relative to the face size
+        self.margin = margin
+
+        # Last face box (x, y, w, h) and frames since the last full frame detection
+        self.box = None
+        self.frames_since_detection = 0
+
+    def detect(self, gray):
+        if self.box is not None and self.frames_since_detection < self.detect_interval:
+            # Searches the face only in a window around the last box
+            faces = self.search_window(gray)
+            self.frames_since_detection += 1
+        else:
+            faces = ()
+
+        # Runs the full frame detection when it is scheduled or when the face was lost in the window
+        if len(faces) == 0:
+            resolution, params = self.params.get('face')
+            faces = detect_scaled(self.cascade, gray, resolution, params)
+            self.frames_since_detection = 0
+
+        # Follows the first face found
+        self.box = tuple(faces[0]) if len(faces) > 0 else None
+        return faces
+
+    def search_window(self, gray):
+        x, y, w, h = self.box
+        # Window coordinates [y0:y1, x0:x1] clipped to the frame
+        x0 = max(x - int(w * self.margin), 0)
+        y0 = max(y - int(h * self.margin), 0)
+        x1 = min(x + w + int(w * self.margin), gray.shape[1])
+        y1 = min(y + h + int(h * self.margin), gray.shape[0])
+
+        # The face can only change its size a little between frames
+        faces = self.cascade.detectMultiScale(gray[y0:y1, x0:x1], 1.2 + load_step * self.params.load_level, 5,
+                                              minSize=(int(w * 0.7), int(h * 0.7)),
+                                              maxSize=(int(w * 1.4), int(h * 1.4)))
+
+        # Returns the faces in frame coordinates
+        return [(fx + x0, fy + y0, fw, fh) for (fx, fy, fw, fh) in faces]
 
 
 # VideoCamera object that controls all the recognition and avatar changes
 class VideoCamera(object):
-    def __init__(self):
-        # Capturing Video
-        self.video = cv2.VideoCapture(0)
+    # Name of the pipeline in the metrics
+    name = 'student'
+
+    def __init__(self, source=None, detect_interval=5, target_fps=15, resolutions=None, parallel=False, on_event=None):
+        # Capturing video from the given frame source or the local webcam
+        self.video = source if source is not None else DeviceSource(0)
 
         # Count of frames with each gesture
         self.sleep_frames = 0
@@ -64,51 +243,115 @@ class VideoCamera(object):
         self.no_smile_frames = 0
         self.wait_frames = 15
 
+        # Avatar state of the session and function called with the gesture events
+        self.avatar_state = 'neutral'
+        self.on_event = on_event
+
+        # Detectors of the camera, adaptive cascade parameters and face detection scheduler
+        self.cascades = Cascades()
+        self.params = AdaptiveParams(target_fps, resolutions)
+        self.face_tracker = FaceTracker(self.cascades.face, self.params, detect_interval)
+        # Runs the face, palm and fist detectors in the detector pool
+        self.parallel = parallel
+
+        # Timer of the pipeline stages
+        self.timer = StageTimer(self.name)
+
     def __del__(self):
-        # Releasing camera
+        # Releasing the frame source
         self.video.release()
 
+    def set_state(self, state):
+        # Changes the avatar and reports the gesture event of the new state, only when the state changes
+        if state == self.avatar_state:
+            return
+        self.avatar_state = state
+        if self.on_event is not None and state in state_events:
+            self.on_event(state_events[state])
+
+    def detect_face(self, gray):
+        # Detects or follows the face in the actual frame
+        faces = self.face_tracker.detect(gray)
+
+        # Smile Detections in the lower half of the first face, where the mouth is
+        smiles = ()
+        for (x, y, w, h) in faces:
+            roi_gray = gray[y + h // 2:y + h, x:x + w]
+            smiles = self.cascades.smile.detectMultiScale(roi_gray, 3.5, 20, minSize=(w // 4, h // 10), maxSize=(w, h // 2))
+            break
+
+        return faces, smiles
+
+    def detect(self, gray):
+        # Returns the faces, smiles, palms and fists detected in the gray frame
+        if self.parallel:
+            # Dispatches the three detector groups to the pool and waits for all of them
+            face_job = detector_pool.submit(self.detect_face, gray)
+            palm_job = detector_pool.submit(detect_scaled, self.cascades.palm, gray, *self.params.get('palm'))
+            fist_job = detector_pool.submit(detect_scaled, self.cascades.fist, gray, *self.params.get('fist'))
+            faces, smiles = face_job.result()
+            palms = palm_job.result()
+            fists = fist_job.result()
+            self.timer.mark('detect')
+        else:
+            faces, smiles = self.detect_face(gray)
+            self.timer.mark('face_detect')
+            palms = detect_scaled(self.cascades.palm, gray, *self.params.get('palm'))
+            self.timer.mark('palm_detect')
+            fists = detect_scaled(self.cascades.fist, gray, *self.params.get('fist'))
+            self.timer.mark('fist_detect')
+
+        return faces, smiles, palms, fists
+
     def get_frame(self):
+        # Processes a frame and encodes the raw frame to jpg, the avatar is already encoded
+        frame, avatar, state = self.process()
+        ret, jpeg = cv2.imencode('.jpg', frame)
+
+        # Return the encoded images in byte format
+        return jpeg.tobytes(), avatar_cache.jpegs[state]
+
+    def process(self):
         # Extracting frames
+        self.timer.start()
         ret, frame = self.video.read()
+        self.timer.mark('read')
         frame = cv2.resize(frame, None, fx=ds_factor, fy=ds_factor,
         interpolation=cv2.INTER_AREA)
         # Extracting the same frame in gray scale
         gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.timer.mark('preprocess')
 
-        # Defining the avatar variable
-        avatar = icon_img
+        # Runs all the detectors before updating the gesture counters
+        faces, smiles, palms, fists = self.detect(gray)
+        self.params.observe_faces(faces)
 
-        # Detects faces in the actual frame
-        faces = face_cascade.detectMultiScale(gray, 1.2, 5)
         if len(faces) > 0:
             # Restores the count of sleep frames
             self.sleep_frames = 0
             # If the avatar was in sleep mode, shows the active avatar again
             if self.slp:
                 self.slp = False
-                avatar = display_icon(None)
+                self.set_state('neutral')
 
             # For each face detected
             for (x, y, w, h) in faces:
                 # Draws a green rectangle around the face
                 cv2.rectangle(frame, (x, y), (x + w, y + h), (0, 255, 0), 2)
-                # Region of Interests (face)
-                roi_gray = gray[y:y + h, x:x + w]
+                # The smiles are relative to the lower half of the face
+                roi_top = h // 2
 
-                # Smile Detections in the face region
-                # Detects smiles and change the state of the avatar with a thumb up
-                smiles = smile_cascade.detectMultiScale(roi_gray, 3.5, 20)
+                # Changes the state of the avatar with a thumb up when the smiles are held
                 if len(smiles) > 0:
                     for (sx, sy, sw, sh) in smiles:
                         # Draws a red rectangle around the smile
-                        cv2.rectangle(frame, (x + sx, y + sy), (x + sx + sw, y + sy + sh), (0, 0, 255), 3)
+                        cv2.rectangle(frame, (x + sx, y + roi_top + sy), (x + sx + sw, y + roi_top + sy + sh), (0, 0, 255), 3)
                         # Adds one to the smile frames count
                         self.smile_frames += 1
                         # If the total smile frames reaches the wait frames, display the avatar with a thumb up
                         if self.smile_frames == self.wait_frames:
                             self.smile_frames = 0
-                            avatar = display_icon(thumbUp)
+                            self.set_state('thumb_up')
                         # Allows just one smile
                         break
                 else:
@@ -126,10 +369,9 @@ class VideoCamera(object):
             # If the sleep frames reaches 150, enters the sleep mode and display the avatar with the sleep icon
             if self.sleep_frames == 150:
                 self.slp = True
-                avatar = display_icon(sleep)
+                self.set_state('sleep')
 
-        # Detects palms in the current frame and change the state of the avatar with a raised hand
-        palms = open_palm_cascade.detectMultiScale(gray, 1.1, 12)
+        # Palms in the current frame change the state of the avatar with a raised hand
         if len(palms) > 0:
             # For each palm detected
             for (x, y, w, h) in palms:
@@ -140,7 +382,7 @@ class VideoCamera(object):
                 # If the total palm frames reaches the wait frames, display the avatar with a raised hand
                 if self.palm_frames == self.wait_frames:
                     self.palm_frames = 0
-                    avatar = display_icon(hand)
+                    self.set_state('hand')
                 # Allows just one palm
                 break
         else:
@@ -151,8 +393,7 @@ class VideoCamera(object):
                 self.palm_frames = 0
                 self.no_palm_frames = 0
 
-        # Detects fists and change the state of the avatar with a thumb down
-        fists = closed_palm_cascade.detectMultiScale(gray, 1.1, 10)
+        # Fists change the state of the avatar with a thumb down
         if len(fists) > 0:
             # For each fist detected
             for (x, y, w, h) in fists:
@@ -163,7 +404,7 @@ class VideoCamera(object):
                 # If the total fist frames reaches the wait frames, display the avatar with a thumb down
                 if self.fist_frames == self.wait_frames:
                     self.fist_frames = 0
-                    avatar = display_icon(thumbDown)
+                    self.set_state('thumb_down')
                 # Allows just one fist
                 break
         else:
@@ -174,12 +415,11 @@ class VideoCamera(object):
                 self.fist_frames = 0
                 self.no_fist_frames = 0
 
-        # Encode OpenCV raw frame and avatar image to jpg
-        ret, jpeg = cv2.imencode('.jpg', frame)
-        if avatar is not None:
-            ret2, ava = cv2.imencode('.jpg', avatar)
-        else:
-            ret2, ava = cv2.imencode('.jpg', img)
+        self.timer.mark('gestures')
+        self.timer.stop()
 
-        # Return the encoded images in byte format
-        return jpeg.tobytes(), ava.tobytes()
+        # Adapts the cascade parameters to the time spent in the frame
+        self.params.observe_frame(time.perf_counter() - self.timer.started)
+
+        # Return the raw frame, the avatar image and the avatar state that identifies it
+        return frame, avatar_cache.images[self.avatar_state], self.avatar_state
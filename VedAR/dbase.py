@@ -1,18 +1,222 @@
+import queue
 import sqlite3
+import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime
+from metrics import registry
+
+# Pragmas set on every connection to the database file
+# WAL lets the readers run while a writer commits and NORMAL only syncs the WAL at checkpoints
+connection_pragmas = (
+    'PRAGMA journal_mode=WAL',
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA cache_size=-8000',
+)
+# Migrations of the database files created by older versions, applied in order with PRAGMA user_version
+migrations = [
+    # 1: indexes of the messages inbox, the sessions of a user and the calls by start time
+    # users.email already has the index of its UNIQUE constraint
+    '''
+    CREATE INDEX IF NOT EXISTS messages_to_id ON messages (to_id);
+    CREATE INDEX IF NOT EXISTS sessions_user_id ON sessions (user_id);
+    CREATE INDEX IF NOT EXISTS call_start ON call (start);
+    ''',
+    # 2: time of the events, the events table is created without it so every database file gets it here
+    '''
+    ALTER TABLE events ADD COLUMN created_at DATETIME;
+    ''',
+]
+# Messages shown in each page of the inbox
+messages_page_size = 50
+# Seconds a connection waits for the lock of another writer before failing
+busy_timeout = 5.0
+
+
+# Opens a connection to the database file with the pragmas of the server
+def connect(path):
+    conn = sqlite3.connect(path, timeout=busy_timeout, check_same_thread=False)
+    for pragma in connection_pragmas:
+        conn.execute(pragma)
+    return conn
+
+
+# ConnectionPool object that keeps the idle connections to the database file for the next threads
+class ConnectionPool(object):
+    def __init__(self, path, max_idle=8):
+        self.path = path
+        self.max_idle = max_idle
+        self.lock = threading.Lock()
+        self.idle = list()
+
+    def get(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return connect(self.path)
+
+    def put(self, conn):
+        # Discards the changes that were not committed, so the connection does not keep the write lock
+        if conn.in_transaction:
+            conn.rollback()
+        with self.lock:
+            if len(self.idle) < self.max_idle:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, list()
+        for conn in idle:
+            conn.close()
+
+
+# ThreadConnection object that holds the connection and cursor of a thread
+# The connection goes back to the pool when the thread ends
+class ThreadConnection(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self.conn = pool.get()
+        self.cur = self.conn.cursor()
+
+    def __del__(self):
+        self.cur.close()
+        self.pool.put(self.conn)
+
+
+# WriteQueue object that runs the writes of every thread in a single writer thread
+# The writes received within a short window are grouped in one transaction, so they share a single commit
+class WriteQueue(object):
+    def __init__(self, path, window=0.005, batch_size=256, on_rollback=None):
+        self.path = path
+        # Seconds the writer waits for more writes after the first one and maximum writes in a commit
+        self.window = window
+        self.batch_size = batch_size
+        # Called from the writer thread when a transaction or a part of it is undone
+        self.on_rollback = on_rollback
+
+        # Writes waiting to be run and the writer thread
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def submit(self, write, *args):
+        # Queues a write and waits until it is committed, returns its result or raises its error
+        future = Future()
+        self.queue.put((write, args, future))
+        return future.result()
+
+    def post(self, write, *args):
+        # Queues a write without waiting for it
+        self.queue.put((write, args, None))
+
+    def close(self):
+        # Runs the pending writes and stops the writer
+        self.queue.put(None)
+        self.thread.join(5)
+
+    def run(self):
+        # The writer uses its own connection to the database file and controls its transactions
+        conn = connect(self.path)
+        conn.isolation_level = None
+        cur = conn.cursor()
+        running = True
+        while running:
+            # Waits for the first write of the batch
+            batch = [self.queue.get()]
+            deadline = time.monotonic() + self.window
+
+            # Groups the writes received until the batch is full or the window ends
+            while len(batch) < self.batch_size and batch[-1] is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            # The None value closes the writer
+            if batch[-1] is None:
+                running = False
+                batch.pop()
+
+            if batch:
+                self.commit(cur, batch)
+
+        conn.close()
+
+    def commit(self, cur, batch):
+        results = list()
+        try:
+            cur.execute('BEGIN IMMEDIATE')
+            for write, args, future in batch:
+                # Each write runs in a savepoint, so a failed write does not undo the others
+                cur.execute('SAVEPOINT write')
+                try:
+                    results.append((write(cur, *args), None))
+                except Exception as error:
+                    cur.execute('ROLLBACK TO write')
+                    results.append((None, error))
+                    if self.on_rollback is not None:
+                        self.on_rollback()
+                cur.execute('RELEASE write')
+            cur.execute('COMMIT')
+        except sqlite3.Error as error:
+            # Nothing of the batch is stored if the transaction fails
+            if cur.connection.in_transaction:
+                cur.execute('ROLLBACK')
+            if self.on_rollback is not None:
+                self.on_rollback()
+            results = [(None, error)] * len(batch)
+        registry.inc('vedar_db_commits_total')
+        registry.inc('vedar_db_writes_total', len(batch))
+
+        # Answers the writers once the commit finished
+        for (write, args, future), (result, error) in zip(batch, results):
+            if future is None:
+                if error is not None:
+                    print('ERROR SAVING CHANGES')
+            elif error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
 
 
 # Database object that controls all the database management
 class Database(object):
-    def __init__(self):
-        # Creates the connection to the database file and the cursor of the connection
-        self.conn = sqlite3.connect('db.sqlite', check_same_thread=False)
-        self.cur = self.conn.cursor()
+    def __init__(self, path='db.sqlite'):
+        # Each thread uses its own connection and cursor, taken from the pool of connections to the database file
+        self.pool = ConnectionPool(path)
+        self.local = threading.local()
+        # Ids of the role and institution names, only used by the writer thread
+        self.ids = {'role': dict(), 'institutions': dict()}
+        # Background writer of all the changes
+        self.writer = WriteQueue(path, on_rollback=self.forget_ids)
 
     def __del__(self):
-        # Saves the changes in the database and close the connection
+        # Saves the changes in the database and close the connections
+        self.writer.close()
         self.conn.commit()
-        self.cur.close()
+        self.local = None
+        self.pool.close()
+
+    def thread_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.local.connection = ThreadConnection(self.pool)
+        return connection
+
+    @property
+    def conn(self):
+        # Connection of the current thread
+        return self.thread_connection().conn
+
+    @property
+    def cur(self):
+        # Cursor of the connection of the current thread
+        return self.thread_connection().cur
 
     def create_tables(self):
         # Creates the database tables based on the images/database.png diagram
@@ -59,24 +263,32 @@ class Database(object):
         message TEXT );
         ''')
 
+        # Applies the migrations the database file does not have yet
+        version = self.cur.execute('PRAGMA user_version').fetchone()[0]
+        for number, migration in enumerate(migrations[version:], version + 1):
+            self.cur.executescript(migration + 'PRAGMA user_version = %d;' % number)
+
+    def name_id(self, cur, table, name):
+        # Returns the id of a role or institution name, inserting it if it does not exist in the database
+        ids = self.ids[table]
+        if name not in ids:
+            cur.execute('INSERT OR IGNORE INTO %s (name) VALUES (?)' % table, (name,))
+            ids[name] = cur.execute('SELECT id FROM %s WHERE name=?' % table, (name,)).fetchone()[0]
+        return ids[name]
+
+    def forget_ids(self):
+        # The ids inserted by an undone write may not exist
+        for ids in self.ids.values():
+            ids.clear()
+
     def create_user(self, username, email, role, institution, password):
-        # Inserts a new role if it does not exists in the database
-        self.cur.execute('INSERT OR IGNORE INTO role (name) VALUES (?)', (role,))
-        # Selects the id of the given role name
-        role_query = self.cur.execute('SELECT id FROM role WHERE name=?', (role,))
-        role_int = role_query.fetchone()[0]
-
-        # Inserts a new institution if it does not exists in the database
-        self.cur.execute('INSERT OR IGNORE INTO institutions (name) VALUES (?)', (institution,))
-        # Selects the id of the given institution name
-        inst_query = self.cur.execute('SELECT id FROM institutions WHERE name=?', (institution,))
-        institution_int = inst_query.fetchone()[0]
-
-        # Inserts a new user to the database users table
-        self.cur.execute('INSERT INTO users (username, email, password, created_at, role_id, institution_id) VALUES (?,?,?,?,?,?)',
-                         (username, email, password, datetime.utcnow(), int(role_int), int(institution_int)))
-        # Saves the changes
-        self.conn.commit()
+        # Inserts a new user to the database users table, waiting for the commit
+        self.writer.submit(self.insert_user, username, email, role, institution, password)
+
+    def insert_user(self, cur, username, email, role, institution, password):
+        cur.execute('INSERT INTO users (username, email, password, created_at, role_id, institution_id) VALUES (?,?,?,?,?,?)',
+                    (username, email, password, datetime.utcnow(), self.name_id(cur, 'role', role),
+                     self.name_id(cur, 'institutions', institution)))
 
     def verify_user(self, email):
         # Select the email and password from the users table given the email (UNIQUE)
@@ -91,6 +303,13 @@ class Database(object):
         # Returns the email and password retrieved
         return email_s, password_s
 
+    def update_password(self, email, password):
+        # Replaces the password hash of an user given the email (UNIQUE), waiting for the commit
+        self.writer.submit(self.set_password, email, password)
+
+    def set_password(self, cur, email, password):
+        cur.execute('UPDATE users SET password=? WHERE email=?', (password, email))
+
     def search_by_email(self, email):
         # Selects all the information of the users table filtered by email (UNIQUE)
         email_query = self.cur.execute(
@@ -118,48 +337,28 @@ class Database(object):
         return user_data
 
     def save_changes(self, email, username, institution, role, about):
-        # Inserts a new role if it does not exists in the database
-        self.cur.execute('INSERT OR IGNORE INTO role (name) VALUES (?)', (role,))
-        # Selects the id of the given role name
-        role_query = self.cur.execute('SELECT id FROM role WHERE name=?', (role,))
-        role_int = role_query.fetchone()[0]
-
-        # Inserts a new institution if it does not exists in the database
-        self.cur.execute('INSERT OR IGNORE INTO institutions (name) VALUES (?)', (institution,))
-        # Selects the id of the given institution name
-        inst_query = self.cur.execute('SELECT id FROM institutions WHERE name=?', (institution,))
-        institution_int = inst_query.fetchone()[0]
-
-        # Updates the data of an user given the email (UNIQUE)
-        self.cur.execute(
-            'UPDATE users SET username=?, about=?, role_id=?, institution_id=? WHERE email=?',
-            (username, about, role_int, institution_int, email))
-
-        # Saves the changes
-        self.conn.commit()
+        # Updates the data of an user given the email (UNIQUE), waiting for the commit
+        self.writer.submit(self.update_user, email, username, institution, role, about)
 
-    def search_friends_by_email(self, email):
-        # Select the user id from the users table given the email (UNIQUE)
-        email_query = self.cur.execute('SELECT id FROM users WHERE email=?', (email,))
+    def update_user(self, cur, email, username, institution, role, about):
+        cur.execute('UPDATE users SET username=?, about=?, role_id=?, institution_id=? WHERE email=?',
+                    (username, about, self.name_id(cur, 'role', role), self.name_id(cur, 'institutions', institution),
+                     email))
 
+    def search_friends_by_email(self, email):
+        # Selects the username and email of the friends of the user given the email (UNIQUE)
         friends = list()
         try:
-            # Recover the user id
-            user_id = email_query.fetchone()[0]
-
-            # Recover the list of friend ids
-            friends_query = self.cur.execute('SELECT friend_id FROM friends WHERE user_id=?', (user_id,))
-            for friend in friends_query.fetchall():
-                friend_id = friend[0]
-                # For each friend, retrieves the username and email from the users table given the id
-                id_query = self.cur.execute('SELECT username, email FROM users WHERE id=?', (friend_id,))
-                friend_username, friend_email = id_query.fetchone()
+            friends_query = self.cur.execute(
+                'SELECT friend.username, friend.email FROM users JOIN friends ON friends.user_id=users.id JOIN users AS friend ON friend.id=friends.friend_id WHERE users.email=?',
+                (email,))
+            for friend_username, friend_email in friends_query.fetchall():
                 # Appends the Dictionary with the data to the friends List
                 friends.append({
                     'username': friend_username,
                     'email': friend_email,
                 })
-        except Exception as e:
+        except sqlite3.Error:
             print('ERROR SEARCHING FRIENDS')
 
         # Return the List of friends
@@ -179,26 +378,19 @@ class Database(object):
                 friend_email_query = self.cur.execute('SELECT id FROM users WHERE email=?', (friend_email,))
                 friend_id = friend_email_query.fetchone()[0]
 
-                # Recover the list of friend ids
-                friends_query = self.cur.execute('SELECT friend_id FROM friends WHERE user_id=?', (user_id,))
-                friend_ids = friends_query.fetchall()
                 # Verifies if the friend is already in the user friend list
-                for fr in friend_ids:
-                    if friend_id in fr:
-                        errors['already_exists'] = 'Ya ha agregado a ese usuario como amigo'
-                    else:
-                        continue
+                friend_query = self.cur.execute('SELECT 1 FROM friends WHERE user_id=? AND friend_id=?',
+                                                (user_id, friend_id))
+                if friend_query.fetchone() is not None:
+                    errors['already_exists'] = 'Ya ha agregado a ese usuario como amigo'
 
                 # Verifies if both ids are the same
                 if friend_id == user_id:
                     errors['same'] = 'Usted mismo no se puede agregar como amigo'
 
                 if not errors:
-                    # Add the friend and user id into the friends table
-                    self.cur.execute('INSERT INTO friends (user_id, friend_id) VALUES (?, ?)',
-                                     (user_id, friend_id))
-                    # Saves the changes
-                    self.conn.commit()
+                    # Add the friend and user id into the friends table, waiting for the commit
+                    self.writer.submit(self.insert_friend, user_id, friend_id)
             except:
                 errors['no_exists'] = 'El usuario buscado no existe'
         except:
@@ -226,11 +418,8 @@ class Database(object):
                     errors['same'] = 'Usted mismo no se puede enviar un mensaje'
 
                 if not errors:
-                    # Add the friend id, user id, and message into the messages table
-                    self.cur.execute('INSERT INTO messages (from_id, to_id, message) VALUES (?, ?, ?)',
-                                     (user_id, friend_id, message))
-                    # Saves the changes
-                    self.conn.commit()
+                    # Add the friend id, user id, and message into the messages table, waiting for the commit
+                    self.writer.submit(self.insert_message, user_id, friend_id, message)
             except:
                 errors['no_exists'] = 'El usuario buscado no existe'
         except:
@@ -238,48 +427,57 @@ class Database(object):
 
         return errors
 
-    def recover_messages(self, email):
-        # Select the user id from the users table given the email (UNIQUE)
-        email_query = self.cur.execute('SELECT id FROM users WHERE email=?', (email,))
-
+    def recover_messages(self, email, before=None, limit=messages_page_size):
+        # Selects a page of the messages received by the user given the email (UNIQUE), from the newest to the oldest
+        # The next page starts before the id of the last message of the page
         messages = list()
         try:
-            user_id = email_query.fetchone()[0]
-            message_query = self.cur.execute('SELECT from_id, message FROM messages WHERE to_id=?', (user_id,))
+            message_query = self.cur.execute(
+                'SELECT messages.rowid, sender.username, sender.email, messages.message FROM users JOIN messages ON messages.to_id=users.id JOIN users AS sender ON sender.id=messages.from_id WHERE users.email=? AND messages.rowid<? ORDER BY messages.rowid DESC LIMIT ?',
+                (email, before if before is not None else 2 ** 63 - 1, limit))
 
-            for message in message_query.fetchall():
-                from_query = self.cur.execute('SELECT username, email FROM users WHERE id=?', (message[0],))
-                username, from_email = from_query.fetchone()
+            for message_id, username, from_email, message in message_query.fetchall():
                 messages.append({
+                    'id': message_id,
                     'username': username,
                     'email': from_email,
-                    'message': message[1]
+                    'message': message
                 })
-        except:
+        except sqlite3.Error:
             print('ERROR RETRIEVING MESSAGES')
 
         # Return any errors generated
         return messages
 
     def add_session(self, email):
-        # Generate the actual date
-        actual_time = datetime.utcnow()
-        # Adds a new call to the call table
-        self.cur.execute('INSERT INTO call (start) VALUES (?)', (actual_time,))
+        # Adds the session and returns the ids of the user and the call once they are committed
+        return self.writer.submit(self.insert_session, email)
 
-        # Select the id from the recently added call
-        call_query = self.cur.execute('SELECT id FROM call WHERE start=?', (actual_time,))
-        call_id = call_query.fetchone()[0]
+    def insert_session(self, cur, email):
+        # Adds a new call to the call table
+        cur.execute('INSERT INTO call (start) VALUES (?)', (datetime.utcnow(),))
+        call_id = cur.lastrowid
 
         # Select the user id from the users table given the email (UNIQUE)
-        user_query = self.cur.execute('SELECT id FROM users WHERE email=?', (email,))
+        user_query = cur.execute('SELECT id FROM users WHERE email=?', (email,))
         user_id = user_query.fetchone()[0]
 
         # Adds a new session with the corresponding call and user id
-        self.cur.execute('INSERT INTO sessions (call_id, user_id) VALUES (?, ?)', (call_id, user_id))
+        cur.execute('INSERT INTO sessions (call_id, user_id) VALUES (?, ?)', (call_id, user_id))
 
         # Adds one to the session count of the user
-        self.cur.execute('UPDATE users SET sessions = sessions + 1 WHERE email=?', (email,))
+        cur.execute('UPDATE users SET sessions = sessions + 1 WHERE id=?', (user_id,))
+        return user_id, call_id
 
-        # Saves the changes
-        self.conn.commit()
+    def insert_friend(self, cur, user_id, friend_id):
+        cur.execute('INSERT OR IGNORE INTO friends (user_id, friend_id) VALUES (?, ?)', (user_id, friend_id))
+
+    def insert_message(self, cur, user_id, friend_id, message):
+        cur.execute('INSERT INTO messages (from_id, to_id, message) VALUES (?, ?, ?)', (user_id, friend_id, message))
+
+    def insert_event(self, cur, call_id, event, created_at):
+        cur.execute('INSERT INTO events (call_id, event, created_at) VALUES (?, ?, ?)', (call_id, event, created_at))
+
+    def log_event(self, call_id, event):
+        # Queues a gesture event of a call with the time it happened, it never waits for the database
+        self.writer.post(self.insert_event, call_id, event, datetime.utcnow())
@@ -0,0 +1,102 @@
+import threading
+import time
+import cv2
+from metrics import registry
+
+# Encoding profiles from the best to the lightest: (jpg quality, output scale, maximum frames per second)
+profiles = {
+    'high': (90, 1.0, 30),
+    'medium': (70, 0.75, 15),
+    'low': (50, 0.5, 8),
+}
+profile_order = ['high', 'medium', 'low']
+
+
+# Function to encode an image to jpg with the quality and scale of a profile
+def encode_image(image, profile):
+    quality, scale, max_fps = profiles[profile]
+    if scale != 1.0:
+        image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    ret, jpeg = cv2.imencode('.jpg', image, [cv2.IMWRITE_JPEG_QUALITY, quality])
+    return jpeg.tobytes()
+
+
+# EncodedFrame object that keeps the images of a processed frame and encodes them once per profile
+class EncodedFrame(object):
+    def __init__(self, pipeline, seq, images, keys, previous=None):
+        self.pipeline = pipeline
+        self.seq = seq
+        # Raw images (camera frame, processed image) and the keys that identify their content
+        self.images = images
+        self.keys = keys
+
+        # Encoded images by profile, the images with the same key as in the previous frame share its encodings
+        self.encoded = [dict() for image in images]
+        if previous is not None:
+            for index, key in enumerate(keys):
+                if previous.keys[index] == key:
+                    self.encoded[index] = previous.encoded[index]
+        self.lock = threading.Lock()
+        self.locks = dict()
+
+    def encode(self, index, profile):
+        encoded = self.encoded[index]
+        jpeg = encoded.get(profile)
+        if jpeg is not None:
+            return jpeg
+
+        # Only one viewer encodes each image and profile, the others wait for its result
+        with self.lock:
+            lock = self.locks.setdefault((index, profile), threading.Lock())
+        with lock:
+            if profile not in encoded:
+                started = time.perf_counter()
+                encoded[profile] = encode_image(self.images[index], profile)
+                registry.histogram(self.pipeline, 'encode_' + profile).observe(time.perf_counter() - started)
+            return encoded[profile]
+
+
+# ProfileSelector object that chooses the profile of a viewer from how fast it drains the stream
+class ProfileSelector(object):
+    def __init__(self, profile=None, cooldown=30):
+        # A fixed profile disables the automatic selection
+        self.fixed = profile in profiles
+        self.index = profile_order.index(profile) if self.fixed else 0
+        # Minimum frames between profile changes
+        self.cooldown = cooldown
+
+        # Smoothed time the viewer takes to receive a frame, frames since the last change and time of the last frame
+        self.write_time = 0.0
+        self.frames_since_change = 0
+        self.last_sent = 0.0
+
+    @property
+    def profile(self):
+        return profile_order[self.index]
+
+    def interval(self):
+        return 1.0 / profiles[self.profile][2]
+
+    def observe(self, seconds):
+        self.last_sent = time.perf_counter()
+        self.write_time = 0.8 * self.write_time + 0.2 * seconds
+        self.frames_since_change += 1
+        if self.fixed or self.frames_since_change < self.cooldown:
+            return
+
+        # Uses a lighter profile when sending a frame takes a big part of its interval and a better one when it is fast
+        if self.write_time > 0.5 * self.interval() and self.index < len(profile_order) - 1:
+            self.index += 1
+            self.frames_since_change = 0
+        elif self.write_time < 0.1 * self.interval() and self.index > 0:
+            self.index -= 1
+            self.frames_since_change = 0
+
+    def delay(self):
+        # Returns the rest of the interval of the profile since the last frame sent
+        return self.last_sent + self.interval() - time.perf_counter()
+
+    def wait(self):
+        remaining = self.delay()
+        if remaining > 0:
+            time.sleep(remaining)
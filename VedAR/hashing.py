@@ -0,0 +1,72 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from metrics import registry
+
+
+# HasherBusyError is raised when too many passwords are waiting to be hashed
+class HasherBusyError(Exception):
+    pass
+
+
+# Returns the cost (log2 rounds) of a bcrypt hash like $2b$10$...
+def hash_cost(pw_hash):
+    if isinstance(pw_hash, bytes):
+        pw_hash = pw_hash.decode('utf-8', 'replace')
+    try:
+        return int(pw_hash.split('$')[2])
+    except (IndexError, ValueError):
+        return None
+
+
+# PasswordHasher object that hashes and checks the passwords in a few dedicated threads
+# The requests fail fast when the queue is full instead of taking the CPU of the video sessions
+class PasswordHasher(object):
+    def __init__(self, bcrypt, rounds=10, workers=2, max_queue=32):
+        # Flask-Bcrypt object and cost of the new hashes
+        self.bcrypt = bcrypt
+        self.rounds = rounds
+        # Maximum passwords running and waiting at the same time
+        self.max_pending = workers + max_queue
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='hasher')
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def run(self, stage, function, *args):
+        # Runs a function in the hasher threads and waits for its result
+        with self.lock:
+            if self.pending >= self.max_pending:
+                registry.inc('vedar_hash_rejected_total', stage=stage)
+                raise HasherBusyError('Too many passwords waiting to be hashed')
+            self.pending += 1
+        registry.add('vedar_hash_queue_depth', 1)
+        queued = time.perf_counter()
+        try:
+            return self.executor.submit(self.timed, stage, queued, function, *args).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+            registry.add('vedar_hash_queue_depth', -1)
+
+    def timed(self, stage, queued, function, *args):
+        # Adds the time waiting in the queue and the time hashing to the metrics
+        started = time.perf_counter()
+        registry.histogram('auth', stage + '_wait').observe(started - queued)
+        try:
+            return function(*args)
+        finally:
+            registry.histogram('auth', stage).observe(time.perf_counter() - started)
+
+    def hash(self, password):
+        return self.run('hash', self.bcrypt.generate_password_hash, password, self.rounds)
+
+    def check(self, pw_hash, password):
+        # Returns if the password is correct and its new hash if the stored one has a different cost, else None
+        return self.run('check', self.check_and_upgrade, pw_hash, password)
+
+    def check_and_upgrade(self, pw_hash, password):
+        if not self.bcrypt.check_password_hash(pw_hash, password):
+            return False, None
+        if hash_cost(pw_hash) == self.rounds:
+            return True, None
+        return True, self.bcrypt.generate_password_hash(password, self.rounds)
@@ -0,0 +1,115 @@
+import threading
+import time
+from collections import deque
+
+# Quantiles reported for each rolling histogram
+quantiles = (0.5, 0.9, 0.99)
+
+
+# RollingHistogram object that keeps the last observed values and the running totals
+class RollingHistogram(object):
+    def __init__(self, size=600):
+        self.lock = threading.Lock()
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, value):
+        with self.lock:
+            self.samples.append(value)
+            self.count += 1
+            self.total += value
+
+    def snapshot(self):
+        # Returns the quantiles of the window with the running count and sum
+        with self.lock:
+            samples = sorted(self.samples)
+            count, total = self.count, self.total
+
+        values = dict()
+        for q in quantiles:
+            values[q] = samples[min(int(q * len(samples)), len(samples) - 1)] if samples else 0.0
+        return values, count, total
+
+
+# StageTimer object that measures the time between consecutive marks of a frame
+class StageTimer(object):
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.started = 0.0
+        self.last = 0.0
+
+    def start(self):
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        # Adds the time since the previous mark to the histogram of the stage
+        now = time.perf_counter()
+        registry.histogram(self.pipeline, stage).observe(now - self.last)
+        self.last = now
+
+    def stop(self):
+        # Adds the time of the whole frame
+        registry.histogram(self.pipeline, 'total').observe(time.perf_counter() - self.started)
+
+
+# MetricsRegistry object that stores all the metrics and renders them in the Prometheus text format
+class MetricsRegistry(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Histograms by (pipeline, stage)
+        self.histograms = dict()
+        # Counters and gauges by (name, labels)
+        self.counters = dict()
+        self.gauges = dict()
+
+    def histogram(self, pipeline, stage):
+        key = (pipeline, stage)
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            with self.lock:
+                histogram = self.histograms.setdefault(key, RollingHistogram())
+        return histogram
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def add(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.gauges[key] = self.gauges.get(key, 0) + value
+
+    def render(self):
+        lines = list()
+
+        # Stage timings as summaries with the quantiles of the rolling window
+        lines.append('# HELP vedar_stage_seconds Time spent in each stage of the video pipelines')
+        lines.append('# TYPE vedar_stage_seconds summary')
+        with self.lock:
+            histograms = sorted(self.histograms.items(), key=lambda item: item[0])
+        for (pipeline, stage), histogram in histograms:
+            values, count, total = histogram.snapshot()
+            labels = 'pipeline="%s",stage="%s"' % (pipeline, stage)
+            for q in quantiles:
+                lines.append('vedar_stage_seconds{%s,quantile="%s"} %.6f' % (labels, q, values[q]))
+            lines.append('vedar_stage_seconds_sum{%s} %.6f' % (labels, total))
+            lines.append('vedar_stage_seconds_count{%s} %d' % (labels, count))
+
+        # Counters and gauges grouped by name
+        with self.lock:
+            metrics = [('counter', self.counters.copy()), ('gauge', self.gauges.copy())]
+        for kind, values in metrics:
+            for name in sorted(set(key[0] for key in values)):
+                lines.append('# TYPE %s %s' % (name, kind))
+                for (key_name, labels), value in sorted(values.items()):
+                    if key_name == name:
+                        label_text = ','.join('%s="%s"' % label for label in labels)
+                        lines.append('%s{%s} %s' % (name, label_text, value))
+
+        return '\n'.join(lines) + '\n'
+
+
+# Registry shared by all the pipelines and feeds of the server
+registry = MetricsRegistry()
@@ -0,0 +1,302 @@
+import multiprocessing
+import os
+import threading
+import time
+import traceback
+from multiprocessing import resource_tracker, shared_memory
+
+import cv2
+import numpy as np
+
+from sources import DeviceSource
+from strokes import BoardLog
+from camboard import draw_palette
+from metrics import registry
+
+# Largest image in bytes exchanged with the workers (a 1920x1080 BGR frame)
+# Each session has three slots of this size: camera frame, processed frame and processed image
+max_image_bytes = 1920 * 1080 * 3
+
+
+# Copies an image into a slot of a shared memory block and returns its shape
+def write_image(buffer, slot, image):
+    if image.dtype != np.uint8 or image.nbytes > max_image_bytes:
+        raise ValueError('Image too big for the shared memory slot: %s' % (image.shape,))
+    np.ndarray(image.shape, np.uint8, buffer, slot * max_image_bytes)[...] = image
+    return image.shape
+
+
+# Returns a view of the image stored in a slot of a shared memory block
+def read_image(buffer, slot, shape):
+    return np.ndarray(shape, np.uint8, buffer, slot * max_image_bytes)
+
+
+# SharedFrameSource object that gives the worker pipelines the frame written by the server in the shared memory
+class SharedFrameSource(object):
+    def __init__(self, buffer):
+        self.buffer = buffer
+        # Shape of the frame written for the next read
+        self.shape = None
+
+    def read(self):
+        return True, read_image(self.buffer, 0, self.shape)
+
+    def release(self):
+        self.buffer = None
+
+
+# RecordingTimer object that keeps the stage timings of a frame in the worker, so the server adds them to its metrics
+class RecordingTimer(object):
+    def __init__(self):
+        self.started = 0.0
+        self.last = 0.0
+        self.stages = list()
+
+    def start(self):
+        self.started = self.last = time.perf_counter()
+
+    def mark(self, stage):
+        now = time.perf_counter()
+        self.stages.append((stage, now - self.last))
+        self.last = now
+
+    def stop(self):
+        self.stages.append(('total', time.perf_counter() - self.started))
+
+    def collect(self):
+        stages, self.stages = self.stages, list()
+        return stages
+
+
+# WorkerSession object that runs the pipeline of a session inside a worker process
+class WorkerSession(object):
+    def __init__(self, kind, kwargs, memory_name):
+        from camera import VideoCamera
+        from camboard import VideoCameraBoard
+
+        self.memory = shared_memory.SharedMemory(memory_name)
+        # Attaching registers the block in the tracker of the worker, which would unlink it when the worker exits
+        # The block belongs to the PooledCamera that created it, only the server unlinks it
+        resource_tracker.unregister(self.memory._name, 'shared_memory')
+        self.source = SharedFrameSource(self.memory.buf)
+        # Gesture events reported by the pipeline since the last frame
+        self.events = list()
+        if kind == 'student':
+            self.camera = VideoCamera(self.source, on_event=self.events.append, **kwargs)
+        else:
+            self.camera = VideoCameraBoard(self.source, **kwargs)
+        self.camera.timer = RecordingTimer()
+        # Sequence number of the last board change sent to the server
+        self.board_seq = 0
+
+    def describe(self):
+        # Attributes of the pipeline the server proxy needs
+        return {'name': self.camera.name, 'colors': getattr(self.camera, 'colors', None)}
+
+    def process(self, shape):
+        self.source.shape = shape
+        frame, processed, key = self.camera.process()
+        buffer = self.memory.buf
+        shapes = (write_image(buffer, 1, frame), write_image(buffer, 2, processed))
+
+        events = list(self.events)
+        del self.events[:]
+        # Board changes made by this frame, replayed by the server in the same order
+        changes = list()
+        board_log = getattr(self.camera, 'board_log', None)
+        if board_log is not None:
+            changes = board_log.read(self.board_seq, 0) or []
+            self.board_seq = board_log.seq
+        return shapes, key, getattr(self.camera, 'avatar_state', None), events, changes, self.camera.timer.collect()
+
+    def close(self):
+        # The pipeline must drop its views of the shared memory before it is closed
+        self.camera = None
+        self.source = None
+        try:
+            self.memory.close()
+        except BufferError:
+            pass
+
+
+# Main loop of a worker process, runs the commands of the server for every session assigned to it
+def worker_main(conn):
+    sessions = dict()
+    while True:
+        try:
+            message = conn.recv()
+        except (EOFError, OSError):
+            break
+
+        command, session_id, args = message
+        try:
+            if command == 'open':
+                sessions[session_id] = WorkerSession(*args)
+                result = sessions[session_id].describe()
+            elif command == 'process':
+                result = sessions[session_id].process(*args)
+            else:
+                sessions.pop(session_id).close()
+                result = None
+            conn.send((True, result))
+        except Exception:
+            conn.send((False, traceback.format_exc()))
+
+
+# Worker object that keeps the connection with a worker process and its load
+class Worker(object):
+    def __init__(self, process, conn):
+        self.process = process
+        self.conn = conn
+        # The sessions of the worker share its connection
+        self.lock = threading.Lock()
+        # Sessions assigned and smoothed time the worker takes to process a frame
+        self.sessions = 0
+        self.busy = 0.0
+
+    def call(self, command, session_id, *args):
+        with self.lock:
+            self.conn.send((command, session_id, args))
+            ok, result = self.conn.recv()
+        if not ok:
+            raise RuntimeError('Worker %s failed:\n%s' % (self.process.name, result))
+        return result
+
+
+# WorkerPool object that runs the session pipelines in worker processes, one session is always run by the same worker
+class WorkerPool(object):
+    def __init__(self, workers=None):
+        # The workers are forked, so the pool must be created before the server starts any thread
+        context = multiprocessing.get_context('fork')
+        self.lock = threading.Lock()
+        self.workers = list()
+        for i in range(workers or os.cpu_count() or 1):
+            conn, child_conn = context.Pipe()
+            process = context.Process(target=worker_main, args=(child_conn,), name='vedar-worker-%d' % i, daemon=True)
+            process.start()
+            child_conn.close()
+            self.workers.append(Worker(process, conn))
+
+    def assign(self):
+        # Gives the new session to the worker with the fewest sessions, and then with the least busy time
+        with self.lock:
+            worker = min(self.workers, key=lambda w: (w.sessions, w.busy))
+            worker.sessions += 1
+            registry.add('vedar_pool_sessions', 1, worker=worker.process.name)
+        return worker
+
+    def release(self, worker):
+        with self.lock:
+            worker.sessions -= 1
+            registry.add('vedar_pool_sessions', -1, worker=worker.process.name)
+
+
+# PooledCamera object that captures the frames in the server and processes them in a worker of the pool
+# It replays the avatar state, the gesture events and the board changes of the worker pipeline
+class PooledCamera(object):
+    def __init__(self, pool, kind, source=None, on_event=None, **kwargs):
+        # Capturing video from the given frame source or the local webcam
+        self.video = source if source is not None else DeviceSource(0)
+        self.on_event = on_event
+        self.pool = pool
+        self.worker = None
+
+        # Shared memory with the slots of the camera frame, processed frame and processed image
+        self.memory = shared_memory.SharedMemory(create=True, size=3 * max_image_bytes)
+        self.session_id = self.memory.name
+        self.worker = pool.assign()
+        try:
+            info = self.worker.call('open', self.session_id, kind, kwargs, self.memory.name)
+        except Exception:
+            # The worker has no session to close
+            self.pool.release(self.worker)
+            self.worker = None
+            self.memory.close()
+            self.memory.unlink()
+            raise
+        self.name = info['name']
+
+        # Last key and copy of the processed image, it is copied again only when the key changes
+        self.lock = threading.Lock()
+        self.key = None
+        self.processed = None
+
+        # The teacher sessions keep a copy of the board log and the encoded paint interface for the viewers
+        # The student sessions keep the avatar state, like VideoCamera
+        if kind == 'board':
+            self.colors = info['colors']
+            self.board_log = BoardLog()
+            self.paint_jpeg = None
+        else:
+            self.avatar_state = 'neutral'
+
+    def __del__(self):
+        self.close()
+        # Releasing the frame source
+        self.video.release()
+
+    def close(self):
+        if self.worker is None:
+            return
+        worker, self.worker = self.worker, None
+        try:
+            worker.call('close', self.session_id)
+        except Exception:
+            print('ERROR CLOSING WORKER SESSION')
+        self.pool.release(worker)
+        self.memory.close()
+        self.memory.unlink()
+
+    def snapshot(self):
+        # Returns the encoded paint interface with the sequence number of the last change it includes
+        with self.lock:
+            if self.paint_jpeg is None:
+                # Until the worker processes the first frame the board is blank
+                paint = self.processed
+                if paint is None:
+                    paint = np.full((471, 636, 3), 255, np.uint8)
+                    draw_palette(paint, np.zeros((471, 636), np.uint8), self.colors, (0, 0, 0))
+                ret, paint = cv2.imencode('.jpg', paint)
+                self.paint_jpeg = paint.tobytes()
+            return self.board_log.seq, self.paint_jpeg
+
+    def process(self):
+        # Extracting frames and writing them in the shared memory
+        ret, frame = self.video.read()
+        if not ret:
+            raise RuntimeError('The frame source returned no frame')
+        shape = write_image(self.memory.buf, 0, frame)
+
+        # Processes the frame in the worker
+        started = time.perf_counter()
+        (frame_shape, processed_shape), key, state, events, changes, stages = \
+            self.worker.call('process', self.session_id, shape)
+        elapsed = time.perf_counter() - started
+        self.worker.busy = 0.9 * self.worker.busy + 0.1 * elapsed
+
+        # Adds the stage timings of the worker and the time spent exchanging the frame
+        for stage, seconds in stages:
+            registry.histogram(self.name, stage).observe(seconds)
+        registry.histogram(self.name, 'pool').observe(elapsed)
+
+        # The slots are written again by the next frame, so the viewers get copies
+        frame = read_image(self.memory.buf, 1, frame_shape).copy()
+        processed = self.processed
+        if key != self.key or processed is None:
+            processed = read_image(self.memory.buf, 2, processed_shape).copy()
+
+        # Replays the results of the worker pipeline
+        if state is not None:
+            self.avatar_state = state
+        if self.on_event is not None:
+            for event in events:
+                self.on_event(event)
+        with self.lock:
+            for change in changes:
+                change = dict(change)
+                change.pop('seq')
+                self.board_log.add(change.pop('type'), **change)
+            if processed is not self.processed:
+                self.processed, self.key = processed, key
+                self.paint_jpeg = None
+        return frame, processed, key
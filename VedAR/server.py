@@ -1,26 +1,21 @@
-from flask import Flask, render_template, Response, request, redirect
+from flask import Flask, render_template, Response, request, redirect, abort
 from flask_bcrypt import Bcrypt
-import urllib
-from json import loads
-from camera import VideoCamera
+import time
+from json import dumps
+from functools import partial
+from camera import VideoCamera, avatar_cache
 from camboard import VideoCameraBoard
+from stream import FrameStream
+from metrics import registry
+from encoding import ProfileSelector
 from dbase import Database
-
-# Email validation with Email Validator by Chema JSON API
-def validate_email(email):
-    # JSON API url and email to validate
-    url = 'https://garridodiaz.com/emailvalidator/index.php?email=' + email
-    # Parse to url format
-    url_parsed = urllib.parse.urlparse(url)
-    # Create a request to get the webpage
-    req = urllib.request.Request(url_parsed.geturl(), headers={'User-Agent': 'Mozilla/5.0'})
-
-    # Open the webpage handle
-    file_handle = urllib.request.urlopen(req)
-    # Loads the JSON generated by the API
-    # {"valid":false,"message":"No valid email format"}
-    data = loads(file_handle.read())
-    return data['valid']
+from cache import CachedDatabase
+from sessions import SessionRegistry, SessionLimitError
+from sources import PushSource
+from validation import EmailValidator, RemoteValidator
+from hashing import PasswordHasher, HasherBusyError
+from asyncstream import StreamingServer
+from pool import WorkerPool, PooledCamera
 
 # Validate all the data from the registration page
 # Creates and returns a dictionary with the errors generated with the data
@@ -43,26 +38,59 @@ def validate_register(username, email, password, password_repeat):
         errors['email'] = 'Este email ya tiene una cuenta en VedAR'
 
     # Verifies if the email is valid
-    if 'email' not in errors and not validate_email(email):
+    if 'email' not in errors and not email_validator.validate(email):
         errors['email'] = 'El email debe ser válido'
     return errors
 
+# Parses an HSV color given as 'h,s,v' in the query string, returns the default value if it is not valid
+def parse_hsv(value, default):
+    try:
+        hsv = tuple(int(v) for v in value.split(','))
+    except (AttributeError, ValueError):
+        return default
+    if len(hsv) != 3 or not all(0 <= v <= 255 for v in hsv):
+        return default
+    return hsv
+
 # Creates the app
 app = Flask(__name__, template_folder="templates")
 # Creates a Bcrypt object
 bcrypt = Bcrypt(app)
-
-# Initializes the cam with a NoneType value and the database with a new Database() object
-cam = None
-database = Database()
+# Hashes and checks the passwords in a few dedicated threads, the stored hashes are upgraded to the configured cost
+password_rounds = 10
+hasher = PasswordHasher(bcrypt, password_rounds, workers=2, max_queue=32)
+# Error shown when too many passwords are waiting to be hashed
+busy_error = 'El servidor está ocupado, inténtalo de nuevo en unos segundos'
+
+# Maximum frames per second processed by the capture worker of each session
+max_fps = 30
+# Seconds after which a feed sends its last image again while the images do not change, so disconnections are noticed
+resend_interval = 5.0
+# Port of the asyncio server of the video feeds and event streams, None serves them only from Flask
+streaming_port = 5001
+# StreamingServer object, None until it is started
+streaming_server = None
+# Maximum sessions running at the same time and seconds a session lives without viewers
+max_sessions = 8
+session_timeout = 60.0
+# Runs the face, palm and fist detectors of the student sessions concurrently
+parallel_detection = False
+# Worker processes that run the session pipelines, 0 runs them in the server process
+pool_workers = 0
+# The workers are forked before the server starts any thread
+pool = WorkerPool(pool_workers) if pool_workers else None
+# Email validation with Email Validator by Chema JSON API, checked locally first
+# The registration never waits more than the timeout for the API
+email_validation_url = 'https://garridodiaz.com/emailvalidator/index.php?email={email}'
+email_validator = EmailValidator(RemoteValidator(email_validation_url, timeout=2.0))
+# Initializes the registry of the running sessions and the database with a new Database() object
+sessions = SessionRegistry(max_sessions, session_timeout)
+database = CachedDatabase(Database())
 database.create_tables()
 
 # It is routed to the home page
 @app.route('/home')
 def index():
-    # The cam becomes NoneType
-    global cam
-    cam = None
     # Renders the home webpage
     return render_template('index.html')
 
@@ -85,9 +113,15 @@ def login():
             errors['email'] = 'El correo ingresado no ha sido registrado'
         else:
             # Compares the hash of the passwords
-            password_correct = bcrypt.check_password_hash(password_s, password)
+            try:
+                password_correct, new_hash = hasher.check(password_s, password)
+            except HasherBusyError:
+                return render_template('login.html', errors={'password': busy_error}), 503
             if not password_correct:
                 errors['password'] = 'Contraseña incorrecta'
+            elif new_hash is not None:
+                # Stores the hash with the configured cost
+                database.update_password(email, new_hash)
 
         # Verifies if errors were generated
         if errors:
@@ -124,7 +158,10 @@ def register():
             return render_template('register.html', errors=errors)
         else:
             # Hashes the password
-            pw_hashed = bcrypt.generate_password_hash(password, 10)
+            try:
+                pw_hashed = hasher.hash(password)
+            except HasherBusyError:
+                return render_template('register.html', errors={'password': busy_error}), 503
             # Stores the data in the database
             database.create_user(username, email, str(role), institution, pw_hashed)
             # Renders the user page
@@ -137,9 +174,6 @@ def register():
 # It is routed to the users's account given the email as a parameter to render all the data from the database
 @app.route('/user/<email>')
 def user(email):
-    # The cam becomes NoneType
-    global cam
-    cam = None
     # Given the email, it recovers all the data of the user in the form of a Dictionary
     user_data = database.search_by_email(email)
 
@@ -222,7 +256,8 @@ def send_message(email):
     # Given the email, it recovers all the data of the user, friends, and messages in the form of a Dictionaries
     user_data = database.search_by_email(email)
     friends = database.search_friends_by_email(email)
-    messages = database.recover_messages(email)
+    # The older messages are requested with the id of the last message shown as ?before=
+    messages = database.recover_messages(email, request.args.get('before', type=int))
 
     # POST method
     if request.method == 'POST':
@@ -247,60 +282,239 @@ def success(email):
     # Renders the success message sent page
     return render_template('success.html', email=email)
 
+# Registers a new session of the user with the stream returned by the factory and renders its webpage
+def start_session(email, factory):
+    try:
+        # Adds a new user session to the database once the server has a place for it
+        session = sessions.create(email, partial(database.add_session, email), factory)
+    except SessionLimitError:
+        # The server is already running all the pipelines it can
+        return render_template('404.html', title='503',
+                               message='El servidor no tiene capacidad para más sesiones, inténtalo más tarde'), 503
+
+    # Renders the video session webpage, the feeds are requested with the id of the session
+    # The feeds can be requested from the streaming server port, only when it is running
+    port = streaming_server.port if streaming_server is not None else None
+    return render_template('session.html', email=email, session_id=session.id, streaming_port=port)
+
+# Returns the session with the given id, aborting with a 404 error if it is not running
+def find_session(session_id):
+    session = sessions.get(session_id)
+    if session is None:
+        abort(404)
+    return session
+
+# Returns the frame source of a new session, the server webcam or the frames pushed by the browser with ?source=remote
+def session_source():
+    return PushSource() if request.args.get('source') == 'remote' else None
+
 # It is routed to the student session
 @app.route('/user/<email>/student')
 def video(email):
-    # The cam becomes a VideoCamera() object
-    global cam
-    cam = VideoCamera()
-
-    # Adds a new user session to the database
-    database.add_session(email)
-
-    # Renders the video session webpage
-    return render_template('session.html', email=email)
+    source = session_source()
+    # The session stream is a FrameStream() object with a capture worker over a VideoCamera()
+    # The gesture events of the session are stored for its call
+    def factory(call_id):
+        on_event = partial(database.log_event, call_id)
+        if pool is not None:
+            camera = PooledCamera(pool, 'student', source, on_event=on_event, parallel=parallel_detection)
+        else:
+            camera = VideoCamera(source, parallel=parallel_detection, on_event=on_event)
+        return FrameStream(camera, max_fps)
+    return start_session(email, factory)
 
 # It is routed to the teacher session
 @app.route('/user/<email>/board')
 def board(email):
-    # The cam becomes a VideoCameraBoard() object
-    global cam
-    cam = VideoCameraBoard()
-
-    # Adds a new user session to the database
-    database.add_session(email)
-
-    # Renders the video session webpage
-    return render_template('session.html', email=email)
-
-# Captures the webcam frame and yields it as an image
-def gen(camera):
-    while True:
-        # Get camera frame
-        frame = camera.get_frame()[0]
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + frame + b'\r\n\r\n')
-
-# Captures the webcam processed image and yields it as an image
-def gen2(camera):
-    while True:
-        # Get camera processed image
-        processed_image = camera.get_frame()[1]
-        yield (b'--frame\r\n'
-               b'Content-Type: image/jpeg\r\n\r\n' + processed_image + b'\r\n\r\n')
+    # The HSV boundaries of the pen color can be given as ?lower=h,s,v&upper=h,s,v
+    lower = parse_hsv(request.args.get('lower'), (100, 60, 60))
+    upper = parse_hsv(request.args.get('upper'), (140, 255, 255))
+    source = session_source()
+
+    # The session stream is a FrameStream() object with a capture worker over a VideoCameraBoard()
+    def factory(call_id):
+        if pool is not None:
+            camera = PooledCamera(pool, 'board', source, lower=lower, upper=upper)
+        else:
+            camera = VideoCameraBoard(source, lower=lower, upper=upper)
+        return FrameStream(camera, max_fps)
+    return start_session(email, factory)
+
+# It is routed to the frames pushed by the browser of a remote session
+# The body is a JPEG image, or a multipart form with several JPEG images in capture order
+@app.route('/ingest/<session_id>', methods=['POST'])
+def ingest(session_id):
+    session = find_session(session_id)
+    source = getattr(session.stream.camera, 'video', None)
+    if not isinstance(source, PushSource):
+        abort(404)
+
+    # Reads all the frames sent in the request
+    if request.files:
+        jpegs = [f.read() for f in request.files.getlist('frame')]
+    else:
+        jpegs = [request.get_data()]
+    jpegs = [jpeg for jpeg in jpegs if jpeg]
+    if not jpegs:
+        return Response('No se recibió ningún frame', status=400, mimetype='text/plain')
+
+    # Only the newest frame is kept, the frames the pipeline could not process in time are dropped
+    dropped = source.push(jpegs)
+    registry.inc('vedar_frames_ingested_total', len(jpegs), pipeline=session.stream.name)
+    registry.inc('vedar_frames_ingest_dropped_total', dropped, pipeline=session.stream.name)
+    return Response(status=204, headers={'X-Frames-Dropped': str(dropped)})
+
+# Yields one of the images (0: webcam frame, 1: processed image) of the latest frame processed by the session
+def gen(session, index, profile=None):
+    stream = session.stream
+    # Name of the feed in the metrics
+    labels = {'pipeline': stream.name, 'feed': ('video', 'image')[index]}
+    registry.add('vedar_viewers', 1, **labels)
+    session.connect()
+    # Encoding profile of the viewer, chosen from how fast it receives the frames unless one is requested
+    selector = ProfileSelector(profile)
+    try:
+        seq = 0
+        last_key = None
+        last_sent = time.monotonic()
+        while stream.running:
+            # Waits for the next pair of images shared by all the viewers
+            new_seq, frame = stream.read(seq)
+            if frame is None or new_seq == seq:
+                continue
+            # Counts the frames the viewer skipped because it was slower than the pipeline or its profile
+            if seq:
+                registry.inc('vedar_frames_dropped_total', new_seq - seq - 1, **labels)
+            seq = new_seq
+
+            # Skips the images identical to the last one sent, but sends it again from time to time
+            # A disconnected viewer is only noticed when something is written to it
+            if frame.keys[index] == last_key and time.monotonic() - last_sent < resend_interval:
+                continue
+            last_key = frame.keys[index]
+
+            # The image is encoded once per profile and shared by all the viewers with the same profile
+            jpeg = frame.encode(index, selector.profile)
+            started = time.perf_counter()
+            yield (b'--frame\r\n'
+                   b'Content-Type: image/jpeg\r\n\r\n' + jpeg + b'\r\n\r\n')
+            last_sent = time.monotonic()
+            selector.observe(time.perf_counter() - started)
+            selector.wait()
+    finally:
+        # The viewer disconnected or the stream stopped
+        registry.add('vedar_viewers', -1, **labels)
+        session.disconnect()
 
 # It is routed to the frames generated by the webcam
-@app.route('/video_feed')
-def video_feed():
-    return Response(gen(cam),
+# The encoding profile (high, medium or low) can be fixed with ?profile=
+@app.route('/video_feed/<session_id>')
+def video_feed(session_id):
+    return Response(gen(find_session(session_id), 0, request.args.get('profile')),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
 # It is routed to the processed images generated by the webcam
-@app.route('/image_feed')
-def image_feed():
-    return Response(gen2(cam),
+@app.route('/image_feed/<session_id>')
+def image_feed(session_id):
+    return Response(gen(find_session(session_id), 1, request.args.get('profile')),
                     mimetype='multipart/x-mixed-replace; boundary=frame')
 
+# Yields a server-sent event with the avatar state every time it changes
+def gen_states(session):
+    stream = session.stream
+    labels = {'pipeline': stream.name, 'feed': 'avatar_events'}
+    registry.add('vedar_viewers', 1, **labels)
+    session.connect()
+    try:
+        state = None
+        while stream.running:
+            new_state = stream.read_state(state)
+            if new_state == state:
+                # Keeps the connection alive while the avatar does not change
+                yield ': keepalive\n\n'
+                continue
+            state = new_state
+            yield 'event: avatar\ndata: %s\n\n' % state
+    finally:
+        registry.add('vedar_viewers', -1, **labels)
+        session.disconnect()
+
+# It is routed to the avatar state changes of the student session
+@app.route('/avatar_events/<session_id>')
+def avatar_events(session_id):
+    session = find_session(session_id)
+    # The teacher sessions have no avatar
+    if not hasattr(session.stream.camera, 'avatar_state'):
+        abort(404)
+    return Response(gen_states(session), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# It is routed to the avatar image of a state, so the clients render the state changes by themselves
+@app.route('/avatar/<state>.jpg')
+def avatar(state):
+    if state not in avatar_cache.jpegs:
+        return render_template('404.html', title='404'), 404
+    return Response(avatar_cache.jpegs[state], mimetype='image/jpeg',
+                    headers={'Cache-Control': 'public, max-age=86400'})
+
+# Yields the changes of the board as server-sent events, starting after the given sequence number
+def gen_board(session, board, since):
+    stream = session.stream
+    labels = {'pipeline': stream.name, 'feed': 'board_events'}
+    registry.add('vedar_viewers', 1, **labels)
+    session.connect()
+    try:
+        # Sends the colors of the board in RGB so the clients can draw the strokes
+        colors = ['#%02x%02x%02x' % (r, g, b) for (b, g, r) in board.colors]
+        yield 'event: colors\ndata: %s\n\n' % dumps(colors)
+
+        while stream.running:
+            events = board.board_log.read(since)
+            if events is None:
+                # The viewer fell too far behind and has to load a new snapshot
+                since = board.board_log.seq
+                yield 'event: reset\ndata: %d\n\n' % since
+            elif not events:
+                # Keeps the connection alive while the board does not change
+                yield ': keepalive\n\n'
+            else:
+                since = events[-1]['seq']
+                yield ''.join('id: %d\nevent: board\ndata: %s\n\n' % (event['seq'], dumps(event)) for event in events)
+    finally:
+        registry.add('vedar_viewers', -1, **labels)
+        session.disconnect()
+
+# Returns the board of a session, aborting with a 404 error if the session is not a running teacher session
+def find_board(session_id):
+    session = find_session(session_id)
+    board = session.stream.camera
+    if not hasattr(board, 'board_log'):
+        abort(404)
+    return session, board
+
+# It is routed to the changes of the board of a teacher session (new points, colors and clear events)
+@app.route('/board_events/<session_id>')
+def board_events(session_id):
+    session, board = find_board(session_id)
+
+    # Browsers reconnect with the id of the last event received
+    since = request.headers.get('Last-Event-ID', request.args.get('since', 0, type=int), type=int)
+    return Response(gen_board(session, board, since), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache'})
+
+# It is routed to the current image of the board, so the viewers that join late apply the changes after it
+@app.route('/board_snapshot/<session_id>')
+def board_snapshot(session_id):
+    session, board = find_board(session_id)
+    seq, paint = board.snapshot()
+    return Response(paint, mimetype='image/jpeg',
+                    headers={'X-Board-Seq': str(seq), 'Cache-Control': 'no-cache'})
+
+# It is routed to the metrics of the video pipelines in the Prometheus text format
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
 # When a 404 error (page not found) is generated, it is routed to a personalized page
 @app.errorhandler(404)
 def page_not_found(error):
@@ -308,5 +522,12 @@ def page_not_found(error):
 
 # Initializes a new server at the localhost using the port 5000 and debug mode on
 if __name__ == '__main__':
+    # Starts the streaming server next to Flask, the pages use the Flask feeds if it cannot start
+    if streaming_port:
+        try:
+            streaming_server = StreamingServer(sessions, port=streaming_port).start()
+        except OSError:
+            print('ERROR STARTING STREAMING SERVER')
     # defining server ip address and port
-    app.run(host='0.0.0.0', port='5000', debug=True)
+    # The reloader would run the requests in a second process, without the sessions of the streaming server
+    app.run(host='0.0.0.0', port='5000', debug=True, use_reloader=False)
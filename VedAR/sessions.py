@@ -0,0 +1,115 @@
+import secrets
+import threading
+import time
+from metrics import registry
+
+
+# SessionLimitError is raised when the server already runs the maximum number of pipelines
+class SessionLimitError(Exception):
+    pass
+
+
+# Session object that owns the pipeline stream of a user call
+class Session(object):
+    def __init__(self, session_id, email, call_id, stream):
+        self.id = session_id
+        self.email = email
+        self.call_id = call_id
+        self.stream = stream
+
+        # Viewers connected to the feeds and the last time the session was used
+        self.lock = threading.Lock()
+        self.viewers = 0
+        self.last_seen = time.monotonic()
+
+    def touch(self):
+        self.last_seen = time.monotonic()
+
+    def connect(self):
+        with self.lock:
+            self.viewers += 1
+        self.touch()
+
+    def disconnect(self):
+        with self.lock:
+            self.viewers -= 1
+        self.touch()
+
+    def idle(self, timeout):
+        return self.viewers <= 0 and time.monotonic() - self.last_seen > timeout
+
+
+# SessionRegistry object that keeps the sessions running on the server, keyed by user and call id
+class SessionRegistry(object):
+    def __init__(self, max_sessions=8, idle_timeout=60.0):
+        # Maximum pipelines running at the same time and seconds a session lives without viewers
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.sessions = dict()
+        # Sessions whose pipeline is being created
+        self.pending = 0
+
+        # Closes the idle sessions in the background
+        self.reaper = threading.Thread(target=self.run, daemon=True)
+        self.reaper.start()
+
+    def create(self, email, admit, factory):
+        # admit records the call once the session is accepted and returns (user id, call id)
+        # factory returns the pipeline stream of the call id
+        # The previous sessions of the user are replaced, the user camera can only be used by one pipeline
+        self.close_user(email)
+        self.sweep()
+
+        # Reserves a place for the session, the call is recorded and the pipeline created only after the limit is checked
+        with self.lock:
+            if len(self.sessions) + self.pending >= self.max_sessions:
+                raise SessionLimitError('Too many sessions running')
+            self.pending += 1
+        try:
+            _, call_id = admit()
+            # The id gives access to the feeds and the frame ingestion of the session, so it cannot be guessed
+            session = Session(secrets.token_urlsafe(16), email, call_id, factory(call_id))
+        finally:
+            with self.lock:
+                self.pending -= 1
+
+        with self.lock:
+            self.sessions[session.id] = session
+            registry.add('vedar_sessions', 1)
+
+        session.stream.start()
+        return session
+
+    def get(self, session_id):
+        with self.lock:
+            session = self.sessions.get(session_id)
+        if session is not None:
+            session.touch()
+        return session
+
+    def close(self, session_id):
+        with self.lock:
+            session = self.sessions.pop(session_id, None)
+            if session is not None:
+                registry.add('vedar_sessions', -1)
+        # Stops the capture worker, the viewers end their feeds
+        if session is not None:
+            session.stream.stop()
+
+    def close_user(self, email):
+        with self.lock:
+            ids = [session.id for session in self.sessions.values() if session.email == email]
+        for session_id in ids:
+            self.close(session_id)
+
+    def sweep(self):
+        with self.lock:
+            ids = [session.id for session in self.sessions.values() if session.idle(self.idle_timeout)]
+        for session_id in ids:
+            self.close(session_id)
+
+    def run(self):
+        while True:
+            time.sleep(max(self.idle_timeout / 4, 1))
+            self.sweep()
@@ -0,0 +1,166 @@
+import os
+import threading
+import cv2
+import numpy as np
+
+# Image extensions read by the ImageDirSource
+image_extensions = ('.jpg', '.jpeg', '.png', '.bmp')
+
+
+# DeviceSource object that reads the frames of a local webcam
+class DeviceSource(object):
+    def __init__(self, index=0):
+        # Capturing video
+        self.video = cv2.VideoCapture(index)
+
+    def read(self):
+        return self.video.read()
+
+    def release(self):
+        # Releasing camera
+        self.video.release()
+
+
+# VideoFileSource object that replays the frames of a video file
+class VideoFileSource(object):
+    def __init__(self, path, loop=True):
+        self.path = path
+        self.loop = loop
+        self.video = cv2.VideoCapture(path)
+
+    def read(self):
+        ret, frame = self.video.read()
+        # Restarts the video when it ends
+        if not ret and self.loop:
+            self.video.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.video.read()
+        return ret, frame
+
+    def release(self):
+        self.video.release()
+
+
+# ImageDirSource object that replays the images of a directory in name order
+class ImageDirSource(object):
+    def __init__(self, path, loop=True):
+        self.path = path
+        self.loop = loop
+        self.index = 0
+
+        # Decodes all the images once so the replay does not depend on the disk
+        names = sorted(name for name in os.listdir(path) if name.lower().endswith(image_extensions))
+        self.frames = [cv2.imread(os.path.join(path, name)) for name in names]
+        self.frames = [frame for frame in self.frames if frame is not None]
+
+    def read(self):
+        # Restarts the sequence when it ends
+        if self.index >= len(self.frames):
+            if not self.loop or not self.frames:
+                return False, None
+            self.index = 0
+
+        # Returns a copy because the pipelines draw over the frames
+        frame = self.frames[self.index].copy()
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        self.frames = []
+
+
+# SyntheticSource object that generates a deterministic sequence of frames with a moving blue marker
+class SyntheticSource(object):
+    def __init__(self, width=640, height=480, length=120, loop=True):
+        self.loop = loop
+        self.index = 0
+
+        # Background with a fixed gradient
+        background = np.zeros((height, width, 3), np.uint8)
+        background[:, :, 1] = np.linspace(40, 200, width, dtype=np.uint8)
+        background[:, :, 2] = np.linspace(200, 40, height, dtype=np.uint8)[:, None]
+
+        # Pre-generates the frames with the marker moving along a circle
+        self.frames = list()
+        for i in range(length):
+            angle = 2 * np.pi * i / length
+            center = (int(width / 2 + width / 4 * np.cos(angle)), int(height / 2 + height / 4 * np.sin(angle)))
+            frame = background.copy()
+            cv2.circle(frame, center, 15, (255, 0, 0), -1)
+            self.frames.append(frame)
+
+    def read(self):
+        # Restarts the sequence when it ends
+        if self.index >= len(self.frames):
+            if not self.loop:
+                return False, None
+            self.index = 0
+
+        # Returns a copy because the pipelines draw over the frames
+        frame = self.frames[self.index].copy()
+        self.index += 1
+        return True, frame
+
+    def release(self):
+        self.frames = []
+
+
+# PushSource object that keeps the latest frame pushed by a remote client, the older frames are dropped
+class PushSource(object):
+    def __init__(self):
+        self.condition = threading.Condition()
+        # Latest frame decoded and not read yet
+        self.frame = None
+        self.closed = False
+
+    def push(self, jpegs):
+        # Only the newest valid frame of the batch is decoded, the pipeline would skip the others
+        # Returns the number of frames dropped, including a previous frame that was not read yet
+        frame = None
+        dropped = len(jpegs)
+        for jpeg in reversed(jpegs):
+            frame = cv2.imdecode(np.frombuffer(jpeg, np.uint8), cv2.IMREAD_COLOR)
+            if frame is not None:
+                break
+        if frame is None:
+            return dropped
+
+        with self.condition:
+            dropped -= 1 if self.frame is None else 0
+            self.frame = frame
+            self.condition.notify_all()
+        return dropped
+
+    def wait(self, timeout=1.0):
+        # Waits for a frame that was not read yet, returns False if none arrived
+        with self.condition:
+            self.condition.wait_for(lambda: self.frame is not None or self.closed, timeout)
+            return self.frame is not None
+
+    def read(self):
+        with self.condition:
+            # The frame is given to the pipeline, which draws over it, so it is read only once
+            frame, self.frame = self.frame, None
+            return frame is not None, frame
+
+    def release(self):
+        with self.condition:
+            self.closed = True
+            self.frame = None
+            self.condition.notify_all()
+
+
+# Creates a frame source from a text description
+# 'device:0', 'video:clip.mp4', 'images:directory/', 'synthetic' or 'push'
+def open_source(spec):
+    kind, _, value = spec.partition(':')
+    if kind == 'device':
+        return DeviceSource(int(value or 0))
+    if kind == 'video':
+        return VideoFileSource(value)
+    if kind == 'images':
+        return ImageDirSource(value)
+    if kind == 'synthetic':
+        return SyntheticSource()
+    if kind == 'push':
+        return PushSource()
+    raise ValueError('Unknown frame source: ' + spec)
@@ -0,0 +1,109 @@
+import threading
+import time
+from metrics import registry
+from encoding import EncodedFrame
+
+
+# FrameStream object that runs the camera pipeline in a background thread and shares the latest result with every viewer
+class FrameStream(object):
+    def __init__(self, camera, max_fps=30):
+        # Camera pipeline (VideoCamera or VideoCameraBoard) that produces the frames
+        self.camera = camera
+        # Maximum number of frames processed per second (None or 0 disables the cap)
+        self.max_fps = max_fps
+        self.condition = threading.Condition()
+
+        # Sequence number and EncodedFrame with the (camera frame, processed image) pair of the last processed frame
+        self.seq = 0
+        self.frame = None
+        # Avatar state of the last processed frame (None for pipelines without avatar)
+        self.state = None
+
+        # Name of the pipeline in the metrics
+        self.name = getattr(camera, 'name', 'camera')
+
+        # Capture and processing worker
+        self.running = False
+        self.thread = None
+        # Functions called from the worker on every new frame and when the stream stops
+        self.listeners = list()
+
+    def start(self):
+        with self.condition:
+            # Starts the worker just once
+            if self.running:
+                return self
+            self.running = True
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+        return self
+
+    def stop(self):
+        with self.condition:
+            # Stops the worker and wakes up all the viewers waiting for a frame
+            self.running = False
+            self.condition.notify_all()
+        self.notify()
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def notify(self):
+        with self.condition:
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def run(self):
+        interval = 1.0 / self.max_fps if self.max_fps else 0
+        # The sources pushed by remote clients are processed only when a new frame arrives
+        wait = getattr(getattr(self.camera, 'video', None), 'wait', None)
+        while self.running:
+            if wait is not None and not wait():
+                continue
+            started = time.perf_counter()
+            try:
+                # Captures and processes one frame
+                frame, processed, key = self.camera.process()
+            except Exception:
+                print('ERROR PROCESSING FRAME')
+                self.stop()
+                break
+
+            # Replaces the latest frame slot and notifies the viewers
+            with self.condition:
+                self.seq += 1
+                # The camera frames are always different, the processed images are identified by their key
+                self.frame = EncodedFrame(self.name, self.seq, (frame, processed), (self.seq, key), self.frame)
+                self.state = getattr(self.camera, 'avatar_state', None)
+                self.condition.notify_all()
+            self.notify()
+            registry.inc('vedar_frames_processed_total', pipeline=self.name)
+
+            # Waits the rest of the frame interval to respect the FPS cap
+            elapsed = time.perf_counter() - started
+            if elapsed < interval:
+                time.sleep(interval - elapsed)
+
+        # Drops the reference to the camera so it can be released
+        self.camera = None
+
+    def read(self, last_seq, timeout=1.0):
+        with self.condition:
+            # Waits for a frame newer than the last one the viewer read
+            # Slow viewers just get the latest frame, skipping the ones processed in between
+            self.condition.wait_for(lambda: self.seq > last_seq or not self.running, timeout)
+
+            # Returns the sequence number with the frame
+            return self.seq, self.frame
+
+    def read_state(self, last_state, timeout=15.0):
+        with self.condition:
+            # Waits for the avatar state to be different from the last one the viewer read
+            self.condition.wait_for(lambda: self.state != last_state or not self.running, timeout)
+            return self.state
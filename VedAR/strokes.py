@@ -0,0 +1,137 @@
+import threading
+from collections import deque
+from itertools import islice
+
+import cv2
+import numpy as np
+
+
+# Stroke object that stores the points of a line in a contiguous array
+class Stroke(object):
+    __slots__ = ('points', 'length', 'color', 'thickness')
+
+    def __init__(self, color, thickness, capacity=64):
+        self.points = np.empty((capacity, 2), np.int32)
+        self.length = 0
+        # Index of the color in the board colors and thickness of the line
+        self.color = color
+        self.thickness = thickness
+
+    def append(self, point):
+        # Doubles the array when it is full
+        if self.length == len(self.points):
+            points = np.empty((2 * len(self.points), 2), np.int32)
+            points[:self.length] = self.points
+            self.points = points
+        self.points[self.length] = point
+        self.length += 1
+
+    def last(self):
+        return tuple(int(v) for v in self.points[self.length - 1])
+
+    def array(self):
+        return self.points[:self.length]
+
+
+# StrokeStore object that stores all the strokes of the board with a limit of points
+class StrokeStore(object):
+    def __init__(self, max_points=20000):
+        # Strokes in drawing order, the last one is the stroke being drawn (if any)
+        self.strokes = list()
+        self.current = None
+        # Points stored and maximum points before the oldest strokes are compacted
+        self.total_points = 0
+        self.max_points = max_points
+
+    def add_point(self, point, color, thickness=2):
+        # Returns the previous point of the stroke, or None if the point starts a new stroke
+        previous = None
+        if self.current is not None and self.current.color == color and self.current.thickness == thickness:
+            previous = self.current.last()
+            # Splits the very long strokes, starting the new one at the last point, so they can be compacted too
+            if self.current.length >= self.max_points // 4:
+                self.start_stroke(color, thickness)
+                self.current.append(previous)
+                self.total_points += 1
+        else:
+            # The strokes are only created when they get their first point
+            self.start_stroke(color, thickness)
+
+        self.current.append(point)
+        self.total_points += 1
+        if self.total_points > self.max_points:
+            self.compact()
+        return previous
+
+    def start_stroke(self, color, thickness):
+        self.current = Stroke(color, thickness)
+        self.strokes.append(self.current)
+
+    def end_stroke(self):
+        # The next point starts a new stroke
+        self.current = None
+
+    def clear(self):
+        self.strokes = list()
+        self.current = None
+        self.total_points = 0
+
+    def compact(self):
+        # Drops the oldest strokes until a quarter of the limit is free, keeping at least the last stroke
+        # They are already drawn in the board layers, only their points are released
+        target = self.max_points * 3 // 4
+        dropped = 0
+        while self.total_points > target and dropped < len(self.strokes) - 1:
+            self.total_points -= self.strokes[dropped].length
+            dropped += 1
+        del self.strokes[:dropped]
+
+    def render(self, image, colors):
+        # Draws all the strokes with one polylines call per color and thickness
+        groups = dict()
+        for stroke in self.strokes:
+            groups.setdefault((stroke.color, stroke.thickness), list()).append(stroke.array().reshape(-1, 1, 2))
+        for (color, thickness), lines in groups.items():
+            cv2.polylines(image, lines, False, colors[color], thickness)
+
+
+# BoardLog object that keeps the last changes of the board numbered in order, for the viewers to replay
+class BoardLog(object):
+    def __init__(self, size=4096):
+        self.condition = threading.Condition()
+        # Last changes and sequence number of the newest one
+        self.events = deque(maxlen=size)
+        self.seq = 0
+        # Functions called after every change
+        self.listeners = list()
+
+    def add_listener(self, listener):
+        with self.condition:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        with self.condition:
+            self.listeners.remove(listener)
+
+    def add(self, kind, **values):
+        with self.condition:
+            self.seq += 1
+            values['seq'] = self.seq
+            values['type'] = kind
+            self.events.append(values)
+            self.condition.notify_all()
+            listeners = list(self.listeners)
+        for listener in listeners:
+            listener()
+
+    def read(self, since, timeout=15.0):
+        # Returns the changes after the given sequence number
+        # Returns None if some of them are no longer kept, so the viewer needs a new snapshot
+        with self.condition:
+            self.condition.wait_for(lambda: self.seq > since, timeout)
+            if self.seq <= since:
+                return []
+            first = self.events[0]['seq']
+            if since + 1 < first:
+                return None
+            return list(islice(self.events, since + 1 - first, None))
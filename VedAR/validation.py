@@ -0,0 +1,124 @@
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+import urllib.parse
+import urllib.request
+from json import loads
+from cache import LRUCache
+from metrics import registry
+
+# Syntax of the email addresses accepted by the registration, matched against the whole address
+# The top level domain can be an internationalized one in punycode (xn--...)
+email_pattern = re.compile(r"[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+(\.[A-Za-z0-9!#$%&'*+/=?^_`{|}~-]+)*"
+                           r"@([A-Za-z0-9]([A-Za-z0-9-]{0,61}[A-Za-z0-9])?\.)+([A-Za-z]{2,63}|xn--[A-Za-z0-9-]{1,59})")
+
+# Domains of temporary email services
+disposable_domains = frozenset((
+    '10minutemail.com', 'dispostable.com', 'fakeinbox.com', 'getnada.com', 'guerrillamail.com',
+    'mailinator.com', 'maildrop.cc', 'sharklasers.com', 'temp-mail.org', 'tempmail.com',
+    'throwawaymail.com', 'trashmail.com', 'yopmail.com',
+))
+
+
+# RemoteError is raised when the remote validation is not available
+class RemoteError(Exception):
+    pass
+
+
+# CircuitBreaker object that stops calling a service after several consecutive failures, for a while
+class CircuitBreaker(object):
+    def __init__(self, max_failures=3, reset_timeout=30.0):
+        self.max_failures = max_failures
+        self.reset_timeout = reset_timeout
+        self.lock = threading.Lock()
+        # Consecutive failures and time the circuit was opened
+        self.failures = 0
+        self.opened_at = None
+
+    def allow(self):
+        # The circuit lets one call through after the reset timeout to check if the service is back
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.max_failures:
+                self.opened_at = time.monotonic()
+
+
+# RemoteValidator object that asks a JSON API if an email is valid, {email} in the url is replaced by the email
+# The API answers {"valid": true} or {"valid": false, "message": "..."}
+class RemoteValidator(object):
+    def __init__(self, url, timeout=2.0, breaker=None, workers=2):
+        self.url = url
+        # Seconds the registration waits for the API, including the name resolution and the whole answer
+        self.timeout = timeout
+        self.breaker = breaker if breaker is not None else CircuitBreaker()
+        # The requests run in a few dedicated threads, so the registration stops waiting after the timeout
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='email')
+
+    def fetch(self, email):
+        url = self.url.replace('{email}', urllib.parse.quote(email, safe='@'))
+        req = urllib.request.Request(url, headers={'User-Agent': 'Mozilla/5.0'})
+        # The socket timeout only limits each read, a slow answer is stopped by the timeout of validate
+        with urllib.request.urlopen(req, timeout=self.timeout) as file_handle:
+            return bool(loads(file_handle.read())['valid'])
+
+    def validate(self, email):
+        if not self.breaker.allow():
+            raise RemoteError('Circuit open')
+        try:
+            valid = self.executor.submit(self.fetch, email).result(self.timeout)
+        except Exception as e:
+            # Errors of the API and answers slower than the timeout
+            self.breaker.failure()
+            registry.inc('vedar_email_remote_failures_total')
+            raise RemoteError(str(e) or e.__class__.__name__)
+        self.breaker.success()
+        return valid
+
+
+# EmailValidator object that validates the emails locally and with an optional remote validator
+# The verdicts are cached by domain and by address, the local verdict is used when the remote one is not available
+class EmailValidator(object):
+    def __init__(self, remote=None, mx_lookup=None, max_entries=4096, ttl=3600.0):
+        self.remote = remote
+        # Function that returns if a domain can receive emails, for example by looking for its MX records
+        self.mx_lookup = mx_lookup
+        self.cache = LRUCache('email', max_entries, ttl)
+
+    def check_domain(self, domain):
+        if domain in disposable_domains:
+            return False
+        return self.mx_lookup is None or bool(self.mx_lookup(domain))
+
+    def validate(self, email):
+        # Checks the syntax and the domain without leaving the server
+        if len(email) > 254 or not email_pattern.fullmatch(email):
+            return False
+        local, domain = email.rsplit('@', 1)
+        domain = domain.lower()
+        if len(local) > 64:
+            return False
+        if not self.cache.get(('domain', domain), lambda: self.check_domain(domain)):
+            return False
+        if self.remote is None:
+            return True
+
+        # The remote verdicts are only cached when the remote validator answered
+        try:
+            return self.cache.get(('address', email.lower()), lambda: self.remote.validate(email))
+        except RemoteError:
+            return True
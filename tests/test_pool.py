@@ -0,0 +1,62 @@
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('cv2')
+
+# The pipelines load their cascades and images relative to the VedAR directory
+vedar_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'VedAR')
+sys.path.insert(0, vedar_dir)
+
+
+@pytest.fixture(scope='module')
+def pool():
+    cwd = os.getcwd()
+    os.chdir(vedar_dir)
+    from pool import WorkerPool
+    try:
+        yield WorkerPool(2)
+    finally:
+        os.chdir(cwd)
+
+
+@pytest.mark.parametrize('kind', ['student', 'board'])
+def test_pooled_session_processes_frames(pool, kind):
+    from pool import PooledCamera
+    from sources import SyntheticSource
+
+    events = list()
+    if kind == 'student':
+        camera = PooledCamera(pool, kind, SyntheticSource(), on_event=events.append)
+    else:
+        camera = PooledCamera(pool, kind, SyntheticSource())
+    try:
+        assert camera.name == kind
+        for i in range(5):
+            frame, processed, key = camera.process()
+            assert frame.ndim == 3 and processed.ndim == 3
+        if kind == 'board':
+            # The snapshot of the proxy includes every board change replayed from the worker
+            seq, jpeg = camera.snapshot()
+            assert seq == camera.board_log.seq and jpeg
+            # The board has no avatar, so its avatar events are not served
+            assert not hasattr(camera, 'avatar_state')
+        else:
+            assert camera.avatar_state in ('neutral', 'sleep', 'hand', 'thumb_up', 'thumb_down')
+    finally:
+        camera.close()
+    assert all(worker.sessions == 0 for worker in pool.workers)
+
+
+def test_pooled_board_snapshot_before_first_frame(pool):
+    from pool import PooledCamera
+    from sources import PushSource
+
+    # The viewers that join before the first frame get a blank board
+    camera = PooledCamera(pool, 'board', PushSource())
+    try:
+        seq, jpeg = camera.snapshot()
+        assert seq == 0 and jpeg
+    finally:
+        camera.close()
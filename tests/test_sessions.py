@@ -0,0 +1,38 @@
+import os
+import sys
+
+vedar_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'VedAR')
+sys.path.insert(0, vedar_dir)
+
+import pytest
+
+from sessions import SessionRegistry, SessionLimitError
+
+
+class FakeStream(object):
+    def __init__(self):
+        self.running = False
+
+    def start(self):
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+
+def test_rejected_session_records_no_call():
+    sessions = SessionRegistry(max_sessions=1)
+    calls = list()
+
+    def admit(email):
+        calls.append(email)
+        return 1, len(calls)
+
+    session = sessions.create('a@example.com', lambda: admit('a@example.com'), lambda call_id: FakeStream())
+    assert session.call_id == 1 and session.email == 'a@example.com'
+    assert sessions.get(session.id) is session
+    assert session.stream.running
+
+    with pytest.raises(SessionLimitError):
+        sessions.create('b@example.com', lambda: admit('b@example.com'), lambda call_id: FakeStream())
+    assert calls == ['a@example.com']
@@ -0,0 +1,88 @@
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from json import dumps
+from urllib.parse import urlsplit, parse_qs
+
+vedar_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'VedAR')
+sys.path.insert(0, vedar_dir)
+
+import pytest
+
+from validation import CircuitBreaker, EmailValidator, RemoteError, RemoteValidator
+
+
+# Stand-in of the remote API, the local part of the email chooses the answer
+class StandInHandler(BaseHTTPRequestHandler):
+    requests = list()
+
+    def do_GET(self):
+        email = parse_qs(urlsplit(self.path).query)['email'][0]
+        self.requests.append(email)
+        local = email.split('@')[0]
+        body = dumps({'valid': local != 'invalid'}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if local == 'slow':
+            # Trickles the answer, each read is faster than the socket timeout but the whole answer is not
+            for i in range(len(body)):
+                self.wfile.write(body[i:i + 1])
+                self.wfile.flush()
+                time.sleep(0.1)
+        else:
+            self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def stand_in():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+    server.daemon_threads = True
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/check?email={email}' % server.server_address[1]
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_remote_valid_and_invalid(stand_in):
+    remote = RemoteValidator(stand_in)
+    assert remote.validate('valid@example.com') is True
+    assert remote.validate('invalid@example.com') is False
+
+    # The verdicts of the remote validator are cached by address
+    validator = EmailValidator(remote)
+    del StandInHandler.requests[:]
+    assert validator.validate('invalid@example.com') is False
+    assert validator.validate('invalid@example.com') is False
+    assert StandInHandler.requests == ['invalid@example.com']
+
+
+def test_remote_timeout_is_bounded(stand_in):
+    remote = RemoteValidator(stand_in, timeout=0.2)
+    started = time.monotonic()
+    with pytest.raises(RemoteError):
+        remote.validate('slow@example.com')
+    assert time.monotonic() - started < 0.8
+
+    # The registration falls back to the local verdict
+    assert EmailValidator(RemoteValidator(stand_in, timeout=0.2)).validate('slow@example.com') is True
+
+
+def test_circuit_open_skips_the_remote_api(stand_in):
+    remote = RemoteValidator(stand_in, timeout=0.2, breaker=CircuitBreaker(max_failures=1, reset_timeout=60.0))
+    with pytest.raises(RemoteError):
+        remote.validate('slow@example.com')
+
+    del StandInHandler.requests[:]
+    with pytest.raises(RemoteError, match='Circuit open'):
+        remote.validate('valid@example.com')
+    assert StandInHandler.requests == []